@@ -2,9 +2,30 @@ from __future__ import unicode_literals
 from __future__ import absolute_import
 
 from django.contrib import admin
-from django.contrib.admin.views.main import ChangeList
+from django.contrib.admin.utils import get_fields_from_path
+from django.contrib.admin.utils import lookup_needs_distinct
+from django.contrib.admin.views.main import ChangeList, PAGE_VAR
 from django.contrib.sites.models import Site
 from django.contrib.sites.admin import SiteAdmin
+from django.core.exceptions import FieldDoesNotExist, PermissionDenied
+from django.core.paginator import Paginator
+from django.db.models import Case, Count, Prefetch, When
+from django.http import Http404, JsonResponse
+from django.utils import six
+from django.utils.translation import ugettext_lazy as _
+
+try:
+    from django.urls import reverse
+except ImportError:
+    # Django < 1.10 compatibility
+    from django.core.urlresolvers import reverse
+
+try:
+    from django.contrib.admin.widgets import (AutocompleteSelect,
+                                              AutocompleteSelectMultiple)
+except ImportError:
+    # Django < 2.0 has no autocomplete widgets
+    AutocompleteSelect = AutocompleteSelectMultiple = None
 
 from .forms import SiteForm
 from .models import Alias
@@ -30,7 +51,8 @@ class AliasInline(admin.TabularInline):
 
     def get_queryset(self, request):
         """Returns only non-canonical aliases."""
-        qs = self.model.aliases.get_queryset()
+        # Each row displays its Alias, including the Site's domain
+        qs = self.model.aliases.get_queryset().select_related('site')
         ordering = self.ordering or ()
         if ordering:
             qs = qs.order_by(*ordering)
@@ -43,6 +65,193 @@ SiteAdmin.inlines = type(SiteAdmin.inlines)([AliasInline]) + SiteAdmin.inlines
 SiteAdmin.form = SiteForm
 
 
+class SiteChangeList(ChangeList):
+    """
+    ChangeList for Site that prefetches the non-canonical aliases of the
+    Sites on the current page.
+    """
+
+    def get_queryset(self, request):
+        qs = super(SiteChangeList, self).get_queryset(request)
+        return qs.prefetch_related(Prefetch(
+            'aliases',
+            queryset=Alias.aliases.order_by('domain'),
+            to_attr='prefetched_aliases',
+        ))
+
+
+def SiteAdmin_get_queryset(self, request):
+    """
+    Annotates each Site with the number of its non-canonical Aliases, which
+    are the ones listed by alias_domains.
+    """
+    qs = super(SiteAdmin, self).get_queryset(request)
+    # Count(filter=...) needs Django >= 2.0
+    return qs.annotate(alias_count=Count(Case(When(
+        aliases__is_canonical__isnull=True, then='aliases'
+    ))))
+
+
+def SiteAdmin_get_changelist(self, request, **kwargs):
+    return SiteChangeList
+
+
+def SiteAdmin_alias_count(self, obj):
+    return obj.alias_count
+SiteAdmin_alias_count.short_description = _('aliases')
+SiteAdmin_alias_count.admin_order_field = 'alias_count'
+
+
+def SiteAdmin_alias_domains(self, obj):
+    """Lists the first ``alias_domains_limit`` non-canonical aliases."""
+    aliases = getattr(obj, 'prefetched_aliases', None)
+    if aliases is None:
+        aliases = Alias.aliases.filter(site=obj).order_by('domain')
+        aliases = aliases[:self.alias_domains_limit + 1]
+    domains = [alias.domain for alias in aliases]
+    if len(domains) > self.alias_domains_limit:
+        domains = domains[:self.alias_domains_limit] + ['...']
+    return ', '.join(domains)
+SiteAdmin_alias_domains.short_description = _('other domain names')
+
+# HACK: Monkeypatch alias counts and domains into the Site changelist,
+# without causing a query per Site
+SiteAdmin.list_display = tuple(SiteAdmin.list_display) + ('alias_count',
+                                                          'alias_domains')
+SiteAdmin.alias_domains_limit = 5
+SiteAdmin.get_queryset = SiteAdmin_get_queryset
+SiteAdmin.get_changelist = SiteAdmin_get_changelist
+SiteAdmin.alias_count = SiteAdmin_alias_count
+SiteAdmin.alias_domains = SiteAdmin_alias_domains
+
+
+def get_user_site_choices(request, model_admin=None):
+    """
+    Returns ``(pk, domain)`` for each Site the user of ``request`` is
+    associated with.
+
+    The Sites are resolved once per request, through
+    ``model_admin.get_user_sites()`` when available, and memoized on the
+    request.
+    """
+    try:
+        return request._multisite_user_sites
+    except AttributeError:
+        pass
+    get_user_sites = getattr(model_admin, 'get_user_sites', None)
+    if get_user_sites is None:
+        sites = request.user.get_profile().sites.all()
+    else:
+        sites = get_user_sites(request)
+    request._multisite_user_sites = list(sites.values_list('pk', 'domain'))
+    return request._multisite_user_sites
+
+
+def _remote_model(field):
+    try:
+        try:
+            return field.remote_field.model
+        except AttributeError:
+            return field.rel.to
+    except AttributeError:
+        return None
+
+
+class SiteListFilter(admin.RelatedFieldListFilter):
+    """
+    List filter for relations to Site that only loads the Sites the user
+    is associated with (all of them for super-users).
+
+    When there are more than ``max_choices`` Sites, only the first
+    ``max_choices`` matching the search box are listed.
+    """
+    max_choices = 100
+    template = 'multisite/admin/site_filter.html'
+
+    def __init__(self, field, request, params, model, model_admin,
+                 field_path):
+        self.lookup_kwarg_search = '%s__domain__icontains' % field_path
+        self.search_term = params.get(self.lookup_kwarg_search, '')
+        self.searchable = bool(self.search_term)
+        self.search_params = ()
+        super(SiteListFilter, self).__init__(
+            field, request, params, model, model_admin, field_path
+        )
+
+    def field_choices(self, field, request, model_admin):
+        if request.user.is_superuser:
+            sites = Site.objects.order_by('domain')
+            if self.search_term:
+                sites = sites.filter(domain__icontains=self.search_term)
+            choices = list(
+                sites.values_list('pk', 'domain')[:self.max_choices + 1]
+            )
+        else:
+            search_term = self.search_term.lower()
+            choices = sorted(
+                (choice for choice in get_user_site_choices(request,
+                                                            model_admin)
+                 if search_term in choice[1].lower()),
+                key=lambda choice: choice[1]
+            )
+        if len(choices) > self.max_choices:
+            self.searchable = True
+            choices = choices[:self.max_choices]
+        return choices
+
+    def has_output(self):
+        return self.searchable or super(SiteListFilter, self).has_output()
+
+    def expected_parameters(self):
+        return (super(SiteListFilter, self).expected_parameters() +
+                [self.lookup_kwarg_search])
+
+    def choices(self, changelist):
+        # Other parameters to keep when submitting the search box
+        self.search_params = sorted(
+            (key, value) for key, value in changelist.params.items()
+            if key not in (self.lookup_kwarg_search, PAGE_VAR)
+        )
+        return super(SiteListFilter, self).choices(changelist)
+
+
+class SiteScopedAutocompleteMixin(object):
+    """
+    Autocomplete widget mixin that loads its options from
+    MultisiteModelAdmin.multisite_autocomplete_view, so that they are
+    limited to the user's Sites.
+    """
+    url_name = '%s:%s_%s_multisite_autocomplete'
+
+    def __init__(self, rel, admin_site, *args, **kwargs):
+        self.model = kwargs.pop('model')
+        self.field_name = kwargs.pop('field_name')
+        super(SiteScopedAutocompleteMixin, self).__init__(
+            rel, admin_site, *args, **kwargs
+        )
+
+    def get_url(self):
+        opts = self.model._meta
+        return reverse(
+            self.url_name % (self.admin_site.name, opts.app_label,
+                             opts.model_name),
+            kwargs={'field_name': self.field_name}
+        )
+
+
+if AutocompleteSelect is not None:
+    class SiteScopedAutocompleteSelect(SiteScopedAutocompleteMixin,
+                                       AutocompleteSelect):
+        pass
+
+    class SiteScopedAutocompleteSelectMultiple(SiteScopedAutocompleteMixin,
+                                               AutocompleteSelectMultiple):
+        pass
+else:
+    SiteScopedAutocompleteSelect = None
+    SiteScopedAutocompleteSelectMultiple = None
+
+
 class MultisiteChangeList(ChangeList):
     """
     A ChangeList like the built-in admin one, but it excludes site filters for
@@ -57,21 +266,21 @@ class MultisiteChangeList(ChangeList):
         fair bit of Django's internals.
         """
         get_filters = super(MultisiteChangeList, self).get_filters
-        filter_specs, has_filter_specs = get_filters(request, *args, **kwargs)
+        result = get_filters(request, *args, **kwargs)
+        # Newer versions of Django return more than the filter specs
+        filter_specs, has_filter_specs = result[:2]
+        extra = tuple(result[2:])
         if request.user.is_superuser or not has_filter_specs:
-            return filter_specs, has_filter_specs
+            return result
         new_filter_specs = []
-        profile = request.user.get_profile()
-        user_sites = frozenset(profile.sites.values_list("pk", "domain"))
+        user_sites = frozenset(get_user_site_choices(request,
+                                                     self.model_admin))
         for filter_spec in filter_specs:
-            try:
-                try:
-                    remote_model = filter_spec.field.remote_field.model
-                except AttributeError:
-                    remote_model = filter_spec.field.rel.to
-            except AttributeError:
+            if isinstance(filter_spec, SiteListFilter):
+                # Choices are already limited to the user's sites
                 new_filter_specs.append(filter_spec)
                 continue
+            remote_model = _remote_model(getattr(filter_spec, 'field', None))
             if remote_model is not Site:
                 new_filter_specs.append(filter_spec)
                 continue
@@ -82,7 +291,7 @@ class MultisiteChangeList(ChangeList):
                 filter_spec.lookup_choices.sort()
                 new_filter_specs.append(filter_spec)
 
-        return new_filter_specs, bool(new_filter_specs)
+        return (new_filter_specs, bool(new_filter_specs)) + extra
 
 
 class MultisiteModelAdmin(admin.ModelAdmin):
@@ -93,6 +302,53 @@ class MultisiteModelAdmin(admin.ModelAdmin):
 
     filter_sites_by_current_object = False
 
+    # Site-scoped foreign keys with more choices than this use an
+    # autocomplete widget instead of rendering every option. None disables
+    # the autocomplete widgets.
+    multisite_autocomplete_threshold = None
+    multisite_autocomplete_page_size = 20
+
+    def get_user_sites(self, request):
+        """
+        Returns a queryset of the Sites that the current (non-super) user
+        is associated with.
+
+        Override this if the user's Sites aren't available through
+        ``request.user.get_profile().sites``.
+        """
+        return request.user.get_profile().sites.all()
+
+    def get_user_site_ids(self, request):
+        """
+        Returns the primary keys of the user's Sites, resolved once per
+        request.
+        """
+        return [pk for pk, domain in get_user_site_choices(request, self)]
+
+    def get_list_filter(self, request):
+        """
+        Uses SiteListFilter for the fields in ``list_filter`` that refer to
+        Site.
+        """
+        list_filter = []
+        for item in super(MultisiteModelAdmin, self).get_list_filter(request):
+            if not callable(item) and not isinstance(item, (list, tuple)):
+                field = get_fields_from_path(self.model, item)[-1]
+                if _remote_model(field) is Site:
+                    item = (item, SiteListFilter)
+            list_filter.append(item)
+        return list_filter
+
+    def lookup_allowed(self, lookup, value):
+        for item in self.list_filter:
+            if isinstance(item, (list, tuple)):
+                item = item[0]
+            if isinstance(item, six.string_types) and \
+               lookup == '%s__domain__icontains' % item:
+                # SiteListFilter search box
+                return True
+        return super(MultisiteModelAdmin, self).lookup_allowed(lookup, value)
+
     def get_queryset(self, request):
         """
         Filters lists of items to items belonging to sites assigned to the
@@ -108,46 +364,82 @@ class MultisiteModelAdmin(admin.ModelAdmin):
 
         (As long as you're not a superuser)
         """
-        qs = super(MultisiteModelAdmin, self).queryset(request)
+        qs = super(MultisiteModelAdmin, self).get_queryset(request)
         if request.user.is_superuser:
             return qs
 
-        user_sites = request.user.get_profile().sites.all()
+        user_sites = self.get_user_site_ids(request)
         if hasattr(qs.model, "site"):
             qs = qs.filter(site__in=user_sites)
         elif hasattr(qs.model, "sites"):
-            qs = qs.filter(sites__in=user_sites)
+            qs = self.filter_by_sites(qs, "sites", user_sites)
 
         if hasattr(self, "multisite_filter_fields"):
             for field in self.multisite_filter_fields:
-                qkwargs = {
-                    "{field}__in".format(field=field): user_sites
-                }
-                qs = qs.filter(**qkwargs)
+                qs = self.filter_by_sites(qs, field, user_sites)
 
         return qs
 
+    def filter_by_sites(self, qs, field_path, site_ids):
+        """
+        Filters ``qs`` to objects whose ``field_path`` points to one of
+        ``site_ids``.
+
+        Paths that span multi-valued relations are filtered with a
+        ``pk__in`` subquery, so that rows are not multiplied by the join
+        and no DISTINCT is needed.
+        """
+        lookup = "{field}__in".format(field=field_path)
+        if not lookup_needs_distinct(qs.model._meta, field_path):
+            return qs.filter(**{lookup: site_ids})
+        subquery = qs.model._base_manager.filter(
+            **{lookup: site_ids}
+        ).values("pk")
+        return qs.filter(pk__in=subquery)
+
     def add_view(self, request, form_url='', extra_context=None):
         if self.filter_sites_by_current_object:
             if hasattr(self.model, "site") or hasattr(self.model, "sites"):
-                self.object_sites = tuple()
+                # A new object doesn't belong to any site yet
+                request._multisite_object_sites = tuple()
         return super(MultisiteModelAdmin, self).add_view(request, form_url,
                                                          extra_context)
 
-    def change_view(self, request, object_id, extra_context=None):
-        if self.filter_sites_by_current_object:
-            object_instance = self.get_object(request, object_id)
+    def get_object(self, request, object_id, *args, **kwargs):
+        obj = super(MultisiteModelAdmin, self).get_object(
+            request, object_id, *args, **kwargs
+        )
+        # Keep the object for get_object_site_ids(), so that it doesn't
+        # have to be fetched again.
+        request._multisite_object = obj
+        return obj
+
+    def get_object_site_ids(self, request):
+        """
+        Returns the ids of the sites that the object being added or changed
+        belongs to, or None if there is no such object or it doesn't belong
+        to a site.
+
+        The ids are computed once per request and stored on the request.
+        """
+        try:
+            return request._multisite_object_sites
+        except AttributeError:
+            pass
+        object_instance = getattr(request, "_multisite_object", None)
+        object_sites = None
+        if object_instance is not None:
             try:
-                self.object_sites = object_instance.sites.values_list(
+                object_sites = tuple(object_instance.sites.values_list(
                     "pk", flat=True
-                )
+                ))
             except AttributeError:
-                try:
-                    self.object_sites = (object_instance.site.pk,)
-                except AttributeError:
-                    pass  # assume the object doesn't belong to a site
-        return super(MultisiteModelAdmin, self).change_view(request, object_id,
-                                                            extra_context)
+                site_id = getattr(object_instance, "site_id", None)
+                if site_id is not None:
+                    object_sites = (site_id,)
+                # otherwise, assume the object doesn't belong to a site
+        request._multisite_object_sites = object_sites
+        return object_sites
 
     def handle_multisite_foreign_keys(self, db_field, request, **kwargs):
         """
@@ -189,10 +481,14 @@ class MultisiteModelAdmin(admin.ModelAdmin):
         if request.user.is_superuser:
             user_sites = Site.objects.all()
         else:
-            user_sites = request.user.get_profile().sites.all()
-        if self.filter_sites_by_current_object and \
-           hasattr(self, "object_sites"):
-            sites = user_sites.filter(pk__in=self.object_sites)
+            user_sites = Site.objects.filter(
+                pk__in=self.get_user_site_ids(request)
+            )
+        object_sites = None
+        if self.filter_sites_by_current_object:
+            object_sites = self.get_object_site_ids(request)
+        if object_sites is not None:
+            sites = user_sites.filter(pk__in=object_sites)
         else:
             sites = user_sites
 
@@ -202,26 +498,54 @@ class MultisiteModelAdmin(admin.ModelAdmin):
             remote_model = db_field.rel.to
         if hasattr(remote_model, "site"):
             kwargs["queryset"] = remote_model._default_manager.filter(
-                site__in=user_sites
+                site__in=sites
             )
         if hasattr(remote_model, "sites"):
-            kwargs["queryset"] = remote_model._default_manager.filter(
-                sites__in=user_sites
+            kwargs["queryset"] = self.filter_by_sites(
+                remote_model._default_manager.all(), "sites", sites
             )
         if db_field.name == "site" or db_field.name == "sites":
             kwargs["queryset"] = user_sites
         if hasattr(self, "multisite_indirect_foreign_key_path") and \
            db_field.name in self.multisite_indirect_foreign_key_path.keys():
             fkey = self.multisite_indirect_foreign_key_path[db_field.name]
-            kwargs["queryset"] = remote_model._default_manager.filter(
-                **{fkey: user_sites}
+            kwargs["queryset"] = self.filter_by_sites(
+                remote_model._default_manager.all(), fkey, sites
             )
 
         return kwargs
 
+    def handle_multisite_autocomplete(self, db_field, request, **kwargs):
+        """
+        Switches the site-scoped queryset of ``db_field`` to a
+        site-scoped autocomplete widget when it has more than
+        ``multisite_autocomplete_threshold`` choices.
+        """
+        queryset = kwargs.get("queryset")
+        if self.multisite_autocomplete_threshold is None or \
+           SiteScopedAutocompleteSelect is None or \
+           queryset is None or "widget" in kwargs or \
+           db_field.name in self.raw_id_fields:
+            return kwargs
+        if queryset.count() <= self.multisite_autocomplete_threshold:
+            return kwargs
+
+        if db_field.many_to_many:
+            widget_class = SiteScopedAutocompleteSelectMultiple
+        else:
+            widget_class = SiteScopedAutocompleteSelect
+        kwargs["widget"] = widget_class(
+            db_field.remote_field, self.admin_site,
+            model=self.model, field_name=db_field.name,
+            using=kwargs.get("using"),
+        )
+        return kwargs
+
     def formfield_for_foreignkey(self, db_field, request, **kwargs):
         kwargs = self.handle_multisite_foreign_keys(db_field, request,
                                                     **kwargs)
+        kwargs = self.handle_multisite_autocomplete(db_field, request,
+                                                    **kwargs)
         return super(MultisiteModelAdmin, self).formfield_for_foreignkey(
             db_field, request, **kwargs
         )
@@ -229,10 +553,79 @@ class MultisiteModelAdmin(admin.ModelAdmin):
     def formfield_for_manytomany(self, db_field, request, **kwargs):
         kwargs = self.handle_multisite_foreign_keys(db_field, request,
                                                     **kwargs)
+        kwargs = self.handle_multisite_autocomplete(db_field, request,
+                                                    **kwargs)
         return super(MultisiteModelAdmin, self).formfield_for_manytomany(
             db_field, request, **kwargs
         )
 
+    def get_urls(self):
+        from django.conf.urls import url
+        urls = super(MultisiteModelAdmin, self).get_urls()
+        if SiteScopedAutocompleteSelect is None:
+            # Django < 2.0 has no autocomplete widgets to serve
+            return urls
+        info = self.model._meta.app_label, self.model._meta.model_name
+        return [
+            url(r'^multisite-autocomplete/(?P<field_name>\w+)/$',
+                self.admin_site.admin_view(self.multisite_autocomplete_view),
+                name='%s_%s_multisite_autocomplete' % info),
+        ] + urls
+
+    def multisite_autocomplete_view(self, request, field_name):
+        """
+        Returns the choices of ``field_name`` matching ``term`` as JSON, in
+        the format of Django's autocomplete view, limited to the user's
+        Sites.
+        """
+        try:
+            db_field = self.model._meta.get_field(field_name)
+        except FieldDoesNotExist:
+            raise Http404
+        if db_field.auto_created or \
+           not (db_field.many_to_one or db_field.many_to_many):
+            raise Http404
+        if not (self.has_add_permission(request) or
+                self.has_change_permission(request)):
+            raise PermissionDenied
+
+        queryset = self.handle_multisite_foreign_keys(db_field,
+                                                      request).get("queryset")
+        if queryset is None:
+            raise Http404
+        term = request.GET.get("term", "")
+        if term:
+            queryset = self.search_autocomplete_choices(request, queryset,
+                                                        term)
+        if not queryset.ordered:
+            queryset = queryset.order_by("pk")
+        paginator = Paginator(queryset, self.multisite_autocomplete_page_size)
+        page = paginator.get_page(request.GET.get("page"))
+        return JsonResponse({
+            "results": [
+                {"id": six.text_type(obj.pk), "text": six.text_type(obj)}
+                for obj in page.object_list
+            ],
+            "pagination": {"more": page.has_next()},
+        })
+
+    def search_autocomplete_choices(self, request, queryset, term):
+        """
+        Filters autocomplete choices with the search_fields of the related
+        model's admin, or by domain for Sites.
+        """
+        related_admin = self.admin_site._registry.get(queryset.model)
+        if related_admin is not None and \
+           related_admin.get_search_fields(request):
+            queryset, use_distinct = related_admin.get_search_results(
+                request, queryset, term
+            )
+            if use_distinct:
+                queryset = queryset.distinct()
+        elif queryset.model is Site:
+            queryset = queryset.filter(domain__icontains=term)
+        return queryset
+
     def get_changelist(self, request, **kwargs):
         """
         Restrict the site filter (if there is one) to sites you are
@@ -0,0 +1,475 @@
+# -*- coding: utf-8 -*-
+"""
+Benchmarks for the host resolution hot path.
+
+Seeds Sites and Aliases, including wildcards and ports, in a throwaway test
+database, then times DynamicSiteMiddleware.process_request and its parts.
+Run with::
+
+    DJANGO_SETTINGS_MODULE=multisite.test_settings \\
+        python -m multisite.benchmarks --output benchmarks.json
+
+With ``--admin``, also renders the Site and Alias admin views, and checks
+their query counts against ADMIN_QUERY_BUDGETS.
+
+With ``--provision-sites``, also times and counts the queries of the Alias
+synchronization code for each number of Sites, and checks the counts
+against QUERY_BUDGETS::
+
+    python -m multisite.benchmarks --provision-sites 1000 10000 100000
+
+The report is written as JSON, so that results can be compared between
+releases. The exit status is 1 if a query budget is exceeded.
+"""
+from __future__ import print_function
+from __future__ import unicode_literals
+from __future__ import absolute_import
+
+import argparse
+import json
+import platform
+import sys
+import timeit
+
+from .metrics import QueryStats
+
+
+def seed(sites=100, aliases=10):
+    """
+    Creates ``sites`` Sites named ``<i>.example.com``, each with
+    ``aliases`` Aliases: a wildcard ``*.<i>.example.com``, a port
+    ``<i>.example.com:8000``, and ``alias<j>.<i>.example.org`` for the rest.
+    """
+    from django.contrib.sites.models import Site
+    from .models import Alias
+
+    Site.objects.bulk_create(
+        Site(domain='%d.example.com' % i, name='%d' % i)
+        for i in range(sites)
+    )
+    Alias.canonical.sync_missing(validate=False)
+
+    objs = []
+    for site in Site.objects.filter(domain__endswith='.example.com'):
+        domains = ['*.%s' % site.domain, '%s:8000' % site.domain]
+        domains += ['alias%d.%s' % (j, site.domain.replace('.com', '.org'))
+                    for j in range(aliases - len(domains))]
+        objs.extend(Alias(site=site, domain=domain)
+                    for domain in domains[:aliases])
+    Alias.objects.bulk_create(objs)
+
+
+def measure(func, number, repeat):
+    """Returns timings of ``func``, in seconds per call."""
+    timings = [t / number for t in timeit.repeat(func, number=number,
+                                                 repeat=repeat)]
+    best = min(timings)
+    return {
+        'number': number,
+        'repeat': repeat,
+        'best': best,
+        'mean': sum(timings) / len(timings),
+        'ops_per_sec': 1 / best if best else None,
+    }
+
+
+def run(number=1000, repeat=3):
+    """
+    Times each case against the seeded database and returns the results,
+    by case name.
+    """
+    from django.conf import settings
+    from django.http import Http404
+    from django.test import RequestFactory, override_settings
+    from .middleware import DynamicSiteMiddleware
+    from .models import Alias
+
+    factory = RequestFactory()
+    middleware = DynamicSiteMiddleware()
+    middleware.cache.clear()
+
+    def request(host):
+        return factory.get('/', HTTP_HOST=host)
+
+    hit = request('0.example.com')
+    miss = request('www.1.example.com:8000')
+    miss_key = middleware.get_cache_key('www.1.example.com:8000')
+    unknown = request('unknown.example.net')
+    redirect = request('alias0.2.example.org')
+
+    def process_miss():
+        middleware.cache.delete(miss_key)
+        middleware.process_request(miss)
+
+    def process_unknown():
+        try:
+            middleware.process_request(unknown)
+        except Http404:
+            pass
+
+    cases = [
+        ('process_request.cache_hit',
+         lambda: middleware.process_request(hit)),
+        ('process_request.cache_miss', process_miss),
+        ('process_request.unknown_host', process_unknown),
+        ('process_request.redirect',
+         lambda: middleware.process_request(redirect)),
+        ('resolve.wildcard',
+         lambda: Alias.objects.resolve('www.3.example.com', 8000)),
+        ('resolve.port',
+         lambda: Alias.objects.resolve('3.example.com', 8000)),
+        ('expand_netloc',
+         lambda: Alias.objects._expand_netloc('www.3.example.com', 8000)),
+    ]
+
+    results = {}
+    # Only time multisite, not the validation of ALLOWED_HOSTS
+    with override_settings(ALLOWED_HOSTS=['*'], MULTISITE_FALLBACK=None), \
+            settings.SITE_ID.override(settings.SITE_ID.site_id):
+        for name, func in cases:
+            func()  # Warm up
+            results[name] = measure(func, number=number, repeat=repeat)
+    return results
+
+
+# Maximum number of queries for each provisioning case, as
+# (fixed, per Site), not counting transaction control statements.
+QUERY_BUDGETS = {
+    'sync_all.missing': (2, 2),
+    'sync_all.changed': (2, 2),
+    'sync_all.unchanged': (2, 0),
+    'db_table_created_hook': (2, 0),
+    'sync.unchanged': (0, 1),
+    'site_created_hook': (1, 5),
+}
+
+# Maximum number of transaction control statements for each provisioning
+# case, as (fixed, per Site). Inside a transaction, as in the tests, each
+# atomic block costs a SAVEPOINT and a RELEASE; otherwise only a BEGIN.
+TRANSACTION_BUDGETS = {
+    'sync_all.missing': (0, 2),
+    'sync_all.changed': (0, 2),
+    'sync_all.unchanged': (0, 0),
+    'db_table_created_hook': (0, 0),
+    'sync.unchanged': (0, 0),
+    'site_created_hook': (0, 4),
+}
+
+
+class QueryCounter(QueryStats):
+    """
+    Counts queries, and separately the transaction control statements:
+    BEGIN, SAVEPOINT, RELEASE and ROLLBACK.
+    """
+
+    transaction_statements = ('BEGIN', 'SAVEPOINT', 'RELEASE', 'ROLLBACK')
+
+    def __init__(self):
+        super(QueryCounter, self).__init__()
+        self.transaction_count = 0
+
+    def __call__(self, execute, sql, params, many, context):
+        if sql.lstrip().upper().startswith(self.transaction_statements):
+            self.transaction_count += 1
+            return execute(sql, params, many, context)
+        return super(QueryCounter, self).__call__(execute, sql, params, many,
+                                                  context)
+
+
+def provision(sites):
+    """
+    Times the Alias synchronization code for ``sites`` Sites, replacing
+    all existing Sites and Aliases. Returns the results by case name, with
+    the number of queries and the time taken, in seconds.
+    """
+    import time
+    from django.contrib.sites.models import Site
+    from .models import Alias
+
+    def clear():
+        Alias.objects.all().delete()
+        Site.objects.all().delete()
+
+    results = {}
+
+    def measure_queries(name, func):
+        stats = QueryCounter()
+        stats.install()
+        start = time.time()
+        try:
+            func()
+        finally:
+            stats.uninstall()
+        results[name] = {
+            'sites': sites,
+            'queries': stats.count,
+            'transaction_statements': stats.transaction_count,
+            'seconds': time.time() - start,
+        }
+
+    def change_domains():
+        # Without signals, so that the Aliases are out of sync
+        for site in Site.objects.all():
+            Site.objects.filter(pk=site.pk).update(
+                domain='changed.' + site.domain
+            )
+
+    def sync_each():
+        for site in Site.objects.all():
+            Alias.sync(site=site)
+
+    def create_each():
+        for i in range(sites):
+            Site.objects.create(domain='%d.example.net' % i)
+
+    clear()
+    Site.objects.bulk_create(Site(domain='%d.example.com' % i)
+                             for i in range(sites))
+    measure_queries('sync_all.missing', Alias.canonical.sync_all)
+    change_domains()
+    measure_queries('sync_all.changed', Alias.canonical.sync_all)
+    measure_queries('sync_all.unchanged', Alias.canonical.sync_all)
+    measure_queries('db_table_created_hook', Alias.db_table_created_hook)
+    measure_queries('sync.unchanged', sync_each)
+    # Excludes fetching the Sites
+    results['sync.unchanged']['queries'] -= 1
+
+    clear()
+    measure_queries('site_created_hook', create_each)
+    return results
+
+
+def over_budget(results):
+    """Returns the names of the provisioning cases that exceed their
+    query or transaction budget."""
+    failed = []
+    for name, result in sorted(results.items()):
+        for budgets, key in [(QUERY_BUDGETS, 'queries'),
+                             (TRANSACTION_BUDGETS, 'transaction_statements')]:
+            fixed, per_site = budgets[name]
+            if result[key] > fixed + per_site * result['sites']:
+                failed.append(name)
+                break
+    return failed
+
+
+# Maximum number of queries to render each admin view, by view and user.
+# They must not grow with the number of Sites and Aliases.
+ADMIN_QUERY_BUDGETS = {
+    'site.changelist.superuser': 4,
+    'site.changelist.editor': 6,
+    'site.change.superuser': 2,
+    'site.change.editor': 4,
+    'site.add.superuser': 0,
+    'site.add.editor': 2,
+    'alias.changelist.superuser': 4,
+    'alias.changelist.editor': 6,
+    'alias.change.superuser': 2,
+    'alias.change.editor': 5,
+    'alias.add.superuser': 1,
+    'alias.add.editor': 4,
+}
+
+# Maximum number of transaction control statements for each admin view.
+# The change and add views run in an atomic block.
+ADMIN_TRANSACTION_BUDGETS = {
+    'site.changelist.superuser': 0,
+    'site.changelist.editor': 0,
+    'site.change.superuser': 2,
+    'site.change.editor': 2,
+    'site.add.superuser': 2,
+    'site.add.editor': 2,
+    'alias.changelist.superuser': 0,
+    'alias.changelist.editor': 0,
+    'alias.change.superuser': 2,
+    'alias.change.editor': 2,
+    'alias.add.superuser': 2,
+    'alias.add.editor': 2,
+}
+
+
+def admin_site():
+    """
+    Returns an AdminSite with the Site admin, and an Alias admin scoped to
+    the Sites in ``request.user.multisite_site_ids``.
+    """
+    from django.contrib import admin
+    from django.contrib.sites.admin import SiteAdmin
+    from django.contrib.sites.models import Site
+    from .admin import MultisiteModelAdmin
+    from .models import Alias
+
+    class ScopedAliasAdmin(MultisiteModelAdmin):
+        list_display = ('domain', 'site', 'is_canonical',
+                        'redirect_to_canonical')
+        list_filter = ('site',)
+
+        def get_user_sites(self, request):
+            return Site.objects.filter(
+                pk__in=request.user.multisite_site_ids
+            )
+
+    site = admin.AdminSite(name='multisite_benchmarks')
+    site.register(Site, SiteAdmin)
+    site.register(Alias, ScopedAliasAdmin)
+    return site
+
+
+def run_admin(repeat=3):
+    """
+    Renders the changelist, change and add views of the Site and Alias
+    admins, as a superuser and as an editor of some of the seeded Sites.
+    Returns the query count of the last rendering and the best render
+    time, in seconds, by case name. The first rendering fills caches,
+    like that of content types, so ``repeat`` should be at least 2.
+    """
+    import time
+    from django.conf.urls import url
+    from django.contrib.auth.models import Permission, User
+    from django.contrib.sites.models import Site
+    from django.test import RequestFactory, override_settings
+    from .models import Alias
+
+    site = admin_site()
+    urlconf = type(str('urlconf'), (), {
+        'urlpatterns': [url(r'^admin/', site.urls)],
+    })
+
+    superuser = User.objects.create_superuser(
+        username='multisite_benchmarks_admin', email='admin@example.com',
+        password='admin'
+    )
+    # Django 1.8 doesn't accept is_staff in create_user()
+    editor = User(username='multisite_benchmarks_editor', is_staff=True)
+    editor.set_password('editor')
+    editor.save()
+    editor.user_permissions.add(*Permission.objects.filter(
+        content_type__app_label__in=['multisite', 'sites']
+    ))
+    site_ids = list(Site.objects.order_by('pk').values_list('pk', flat=True))
+    editor_site_ids = site_ids[:len(site_ids) // 2 + 1]
+    # A Site of the editor, with Aliases besides the canonical one
+    alias_pk, site_pk = Alias.aliases.filter(
+        site__in=editor_site_ids
+    ).order_by('pk').values_list('pk', 'site').first()
+
+    views = [
+        ('site.changelist', Site, 'changelist_view', ()),
+        ('site.change', Site, 'change_view', (str(site_pk),)),
+        ('site.add', Site, 'add_view', ()),
+        ('alias.changelist', Alias, 'changelist_view', ()),
+        ('alias.change', Alias, 'change_view', (str(alias_pk),)),
+        ('alias.add', Alias, 'add_view', ()),
+    ]
+    factory = RequestFactory()
+    results = {}
+    with override_settings(ROOT_URLCONF=urlconf):
+        for username, user in [('superuser', superuser),
+                               ('editor', editor)]:
+            for name, model, view, args in views:
+                model_admin = site._registry[model]
+                timings = []
+                for i in range(repeat):
+                    user = User.objects.get(pk=user.pk)
+                    user.multisite_site_ids = editor_site_ids
+                    request = factory.get('/')
+                    request.user = user
+                    stats = QueryCounter()
+                    stats.install()
+                    start = time.time()
+                    try:
+                        response = getattr(model_admin, view)(request, *args)
+                        response.render()
+                    finally:
+                        stats.uninstall()
+                    timings.append(time.time() - start)
+                    if response.status_code != 200:
+                        raise AssertionError('%s returned %d for %s' % (
+                            name, response.status_code, username
+                        ))
+                results['%s.%s' % (name, username)] = {
+                    'queries': stats.count,
+                    'transaction_statements': stats.transaction_count,
+                    'seconds': min(timings),
+                }
+    return results
+
+
+def admin_over_budget(results):
+    """Returns the names of the admin cases that exceed their budgets."""
+    return sorted(
+        name for name, result in results.items()
+        if result['queries'] > ADMIN_QUERY_BUDGETS[name] or
+        result['transaction_statements'] > ADMIN_TRANSACTION_BUDGETS[name]
+    )
+
+
+def report(results, sites, aliases):
+    """Returns the benchmark report, with details of the environment."""
+    import django
+    from django.db import connection
+    return {
+        'python': platform.python_version(),
+        'django': django.get_version(),
+        'database': connection.vendor,
+        'sites': sites,
+        'aliases': aliases,
+        'results': results,
+    }
+
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(description=__doc__.split('\n\n')[0])
+    parser.add_argument('--sites', type=int, default=100)
+    parser.add_argument('--aliases', type=int, default=10,
+                        help='Aliases per Site, besides the canonical one.')
+    parser.add_argument('--number', type=int, default=1000,
+                        help='Calls per timing.')
+    parser.add_argument('--repeat', type=int, default=3)
+    parser.add_argument('--provision-sites', type=int, nargs='*',
+                        default=[],
+                        help='Numbers of Sites for the provisioning cases.')
+    parser.add_argument('--admin', action='store_true',
+                        help='Also render the admin views.')
+    parser.add_argument('--output', default='-',
+                        help='File for the JSON report. Default: stdout.')
+    args = parser.parse_args(argv)
+    if args.aliases < 3:
+        parser.error('--aliases must be at least 3.')
+
+    import django
+    django.setup()
+    from django.db import connection
+
+    old_name = connection.settings_dict['NAME']
+    connection.creation.create_test_db(verbosity=0)
+    try:
+        seed(sites=args.sites, aliases=args.aliases)
+        results = run(number=args.number, repeat=args.repeat)
+        provisioning = {}
+        failed = set()
+        admin = None
+        if args.admin:
+            admin = run_admin(repeat=args.repeat)
+            failed.update(admin_over_budget(admin))
+        for sites in args.provision_sites:
+            provisioning[sites] = provision(sites)
+            failed.update(over_budget(provisioning[sites]))
+    finally:
+        connection.creation.destroy_test_db(old_name, verbosity=0)
+
+    data = report(results, args.sites, args.aliases)
+    data['admin'] = admin
+    data['provisioning'] = provisioning
+    data['over_budget'] = sorted(failed)
+    data = json.dumps(data, indent=2, sort_keys=True)
+    if args.output == '-':
+        print(data)
+    else:
+        with open(args.output, 'w') as f:
+            f.write(data + '\n')
+    return 1 if failed else 0
+
+
+if __name__ == '__main__':
+    sys.exit(main())
@@ -0,0 +1,231 @@
+# -*- coding: utf-8 -*-
+from __future__ import unicode_literals
+from __future__ import absolute_import
+
+import pickle
+import threading
+import time
+import uuid
+from collections import OrderedDict
+
+from django.core.cache import caches
+from django.core.cache.backends.base import DEFAULT_TIMEOUT, BaseCache
+
+
+class _LocalStore(object):
+    """
+    Entries of the local cache, shared by the threads of a process, as
+    (expiry time, pickled value, token) by key. The token is None for
+    entries read from the shared cache; for entries this process wrote,
+    it is the pickled value last written or returned.
+    """
+
+    def __init__(self):
+        self.lock = threading.Lock()
+        self.entries = OrderedDict()
+        self.generation = None
+        self.checked = 0
+
+
+_stores = {}
+_stores_lock = threading.Lock()
+
+
+class TwoTierCache(BaseCache):
+    """
+    Keeps recently used entries of a shared cache in a small in-process
+    LRU cache, so that most reads do not need a network round trip.
+
+    LOCATION names the shared cache in settings.CACHES. OPTIONS may set:
+
+    MAX_ENTRIES
+        The number of entries kept in the process. Default: 300.
+    LOCAL_TIMEOUT
+        Seconds for which an entry is kept in the process. Default: 5.
+    CHECK_INTERVAL
+        Seconds between checks of the generation in the shared cache.
+        Default: 1.
+
+    Deleting an entry or clearing the cache changes the generation, so that
+    all processes drop their local entries within CHECK_INTERVAL seconds.
+    Overwritten entries are only seen by other processes after their local
+    entries expire, unless invalidate() is called.
+    """
+
+    pickle_protocol = pickle.HIGHEST_PROTOCOL
+    generation_key = 'multisite.cache.generation'
+
+    def __init__(self, location, params):
+        super(TwoTierCache, self).__init__(params)
+        options = params.get('OPTIONS', {})
+        self.location = location
+        # Like the cache handler, this instance belongs to a single thread
+        self.shared = caches[location]
+        self.local_timeout = float(options.get('LOCAL_TIMEOUT', 5))
+        self.check_interval = float(options.get('CHECK_INTERVAL', 1))
+        with _stores_lock:
+            self._store = _stores.setdefault(location, _LocalStore())
+
+    def _local_key(self, key, version):
+        return self.shared.make_key(key, version=version)
+
+    def _check_generation(self):
+        """Drops the local entries if another process invalidated them."""
+        store = self._store
+        now = time.time()
+        if now - store.checked < self.check_interval:
+            return
+        generation = self.shared.get(self.generation_key)
+        with store.lock:
+            store.checked = now
+            if generation != store.generation:
+                store.entries.clear()
+                store.generation = generation
+
+    def _get_local(self, key):
+        """Returns the local entry of ``key``, or None."""
+        store = self._store
+        with store.lock:
+            entry = store.entries.get(key)
+            if entry is None:
+                return None
+            if entry[0] <= time.time():
+                del store.entries[key]
+                return None
+            # Mark as most recently used
+            store.entries[key] = store.entries.pop(key)
+        return entry
+
+    def _load_local(self, key, entry):
+        """Returns the value of the local ``entry`` of ``key``."""
+        value = pickle.loads(entry[1])
+        if entry[2] is not None:
+            # Pickling an equal value does not always give the same bytes
+            # (e.g. on Python 2), so let set() compare with this copy
+            token = pickle.dumps(value, self.pickle_protocol)
+            store = self._store
+            with store.lock:
+                if store.entries.get(key) is entry:
+                    store.entries[key] = (entry[0], entry[1], token)
+        return value
+
+    def _set_local(self, key, pickled, timeout=DEFAULT_TIMEOUT,
+                   written=False):
+        timeout = self.get_local_timeout(timeout)
+        store = self._store
+        with store.lock:
+            if timeout <= 0:
+                store.entries.pop(key, None)
+                return
+            store.entries.pop(key, None)
+            store.entries[key] = (time.time() + timeout, pickled,
+                                  pickled if written else None)
+            while len(store.entries) > self._max_entries:
+                store.entries.popitem(last=False)
+
+    def _delete_local(self, key):
+        with self._store.lock:
+            self._store.entries.pop(key, None)
+
+    def get_local_timeout(self, timeout=DEFAULT_TIMEOUT):
+        """Returns the seconds for which an entry is kept in the process."""
+        if timeout is DEFAULT_TIMEOUT:
+            timeout = self.shared.default_timeout
+        if timeout is None:
+            return self.local_timeout
+        return min(timeout, self.local_timeout)
+
+    def invalidate(self):
+        """Makes all processes drop their local entries."""
+        generation = uuid.uuid4().hex
+        self.shared.set(self.generation_key, generation, None)
+        store = self._store
+        with store.lock:
+            store.entries.clear()
+            store.generation = generation
+            store.checked = time.time()
+
+    def get(self, key, default=None, version=None):
+        self._check_generation()
+        local_key = self._local_key(key, version)
+        entry = self._get_local(local_key)
+        if entry is not None:
+            return self._load_local(local_key, entry)
+        value = self.shared.get(key, version=version)
+        if value is None:
+            return default
+        self._set_local(local_key, pickle.dumps(value, self.pickle_protocol))
+        return value
+
+    def get_many(self, keys, version=None):
+        self._check_generation()
+        result = {}
+        missing = []
+        for key in keys:
+            local_key = self._local_key(key, version)
+            entry = self._get_local(local_key)
+            if entry is None:
+                missing.append(key)
+            else:
+                result[key] = self._load_local(local_key, entry)
+        if missing:
+            found = self.shared.get_many(missing, version=version)
+            for key, value in found.items():
+                self._set_local(self._local_key(key, version),
+                                pickle.dumps(value, self.pickle_protocol))
+            result.update(found)
+        return result
+
+    def set(self, key, value, timeout=DEFAULT_TIMEOUT, version=None):
+        self._check_generation()
+        local_key = self._local_key(key, version)
+        pickled = pickle.dumps(value, self.pickle_protocol)
+        entry = self._get_local(local_key)
+        # Skip the round trip if this process recently stored the same
+        # value. Deleting it elsewhere drops the local entry, as above.
+        if entry is not None and entry[2] == pickled:
+            return
+        self.shared.set(key, value, timeout=timeout, version=version)
+        self._set_local(local_key, pickled, timeout, written=True)
+
+    def set_many(self, data, timeout=DEFAULT_TIMEOUT, version=None):
+        failed = self.shared.set_many(data, timeout=timeout, version=version)
+        for key, value in data.items():
+            if not failed or key not in failed:
+                self._set_local(self._local_key(key, version),
+                                pickle.dumps(value, self.pickle_protocol),
+                                timeout, written=True)
+        return failed
+
+    def add(self, key, value, timeout=DEFAULT_TIMEOUT, version=None):
+        added = self.shared.add(key, value, timeout=timeout, version=version)
+        if added:
+            self._set_local(self._local_key(key, version),
+                            pickle.dumps(value, self.pickle_protocol),
+                            timeout, written=True)
+        return added
+
+    def touch(self, key, timeout=DEFAULT_TIMEOUT, version=None):
+        return self.shared.touch(key, timeout=timeout, version=version)
+
+    def incr(self, key, delta=1, version=None):
+        self._delete_local(self._local_key(key, version))
+        return self.shared.incr(key, delta=delta, version=version)
+
+    def delete(self, key, version=None):
+        self.shared.delete(key, version=version)
+        self.invalidate()
+
+    def delete_many(self, keys, version=None):
+        self.shared.delete_many(keys, version=version)
+        self.invalidate()
+
+    def has_key(self, key, version=None):
+        return self.get(key, version=version) is not None
+
+    def clear(self):
+        self.shared.clear()
+        self.invalidate()
+
+    def close(self, **kwargs):
+        self.shared.close(**kwargs)
@@ -12,14 +12,18 @@ class SiteForm(SiteAdmin.form):
     def clean_domain(self):
         domain = self.cleaned_data['domain']
 
-        try:
-            alias = Alias.objects.get(domain=domain)
-        except Alias.DoesNotExist:
-            # New Site that doesn't clobber an Alias
-            return domain
-
-        if alias.site_id == self.instance.pk and alias.is_canonical:
-            return domain
-
-        raise ValidationError('Cannot overwrite non-canonical Alias: "%s"' %
-                              alias.domain)
+        # Any Alias with this domain, except the Site's own canonical one
+        conflicts = Alias.objects.filter(domain__iexact=domain)
+        if self.instance.pk is not None:
+            conflicts = conflicts.exclude(site=self.instance.pk,
+                                          is_canonical=True)
+        conflict = conflicts.values_list('domain', flat=True).first()
+        if conflict is not None:
+            raise ValidationError(
+                'Cannot overwrite non-canonical Alias: "%s"' % conflict
+            )
+
+        # Let the canonical Alias skip checking its domain again when the
+        # Site is saved.
+        self.instance._alias_domain_validated = domain.lower()
+        return domain
@@ -41,14 +41,53 @@ def SiteManager_get_site_by_id(self, site_id):
     Patch _get_site_by_id to retrieve the site from the cache at the
     beginning of the method to avoid a race condition.
     """
+    # The Site memoized by SITE_ID, e.g. for the current request
+    current = getattr(settings.SITE_ID, 'site', None)
+    if current is not None and current.pk == site_id:
+        return current
     models = sys.modules.get(self.__class__.__module__)
     site = models.SITE_CACHE.get(site_id)
     if site is None:
         site = self.get(pk=site_id)
         models.SITE_CACHE[site_id] = site
+    if getattr(settings.SITE_ID, 'memoize', False) and \
+       site.pk == settings.SITE_ID:
+        settings.SITE_ID.site = site
     return site
 
 
+def get_sites_by_id(site_ids):
+    """
+    Returns a dict of the Sites whose ids are in ``site_ids``, by id.
+
+    The Sites are looked up in SITE_CACHE in a single round trip, and those
+    missing from it in a single query. Unknown ids are left out.
+    """
+    from django.contrib.sites import models
+
+    site_ids = set(int(site_id) for site_id in site_ids)
+    if not site_ids:
+        return {}
+    cache = models.SITE_CACHE
+    if hasattr(cache, 'get_many'):
+        sites = cache.get_many(site_ids)
+    else:
+        # SITE_CACHE is a dict
+        sites = dict((site_id, cache[site_id]) for site_id in site_ids
+                     if site_id in cache)
+
+    missing = site_ids.difference(sites)
+    if missing:
+        found = dict((site.pk, site)
+                     for site in models.Site.objects.filter(pk__in=missing))
+        if hasattr(cache, 'set_many'):
+            cache.set_many(found)
+        else:
+            cache.update(found)
+        sites.update(found)
+    return sites
+
+
 class SiteCache(object):
     """Wrapper for SITE_CACHE that assigns a key_prefix."""
 
@@ -89,6 +128,19 @@ class SiteCache(object):
                         value=self._clean_site(value),
                         *args, **kwargs)
 
+    def get_many(self, keys, *args, **kwargs):
+        cache_keys = dict((self._get_cache_key(key), key) for key in keys)
+        result = self._cache.get_many(list(cache_keys), *args, **kwargs)
+        return dict((cache_keys[cache_key], value)
+                    for cache_key, value in result.items())
+
+    def set_many(self, mapping, *args, **kwargs):
+        self._cache.set_many(
+            dict((self._get_cache_key(key), self._clean_site(value))
+                 for key, value in mapping.items()),
+            *args, **kwargs
+        )
+
     def delete(self, key, *args, **kwargs):
         self._cache.delete(key=self._get_cache_key(key), *args, **kwargs)
 
@@ -103,9 +155,18 @@ class SiteCache(object):
         if raw:
             return
         self.set(key=instance.pk, value=instance)
+        _forget_site(instance)
 
     def _site_deleted_hook(self, sender, instance, *args, **kwargs):
         self.delete(key=instance.pk)
+        _forget_site(instance)
+
+
+def _forget_site(site):
+    """Forgets ``site`` if SITE_ID memoized it, as it has changed."""
+    current = getattr(settings.SITE_ID, 'site', None)
+    if current is not None and current.pk == site.pk:
+        settings.SITE_ID.site = None
 
 
 class DictCache(object):
@@ -145,3 +206,11 @@ class DictCache(object):
         """D.key(k[, d]) -> k if D has a key k, else d. Defaults to None"""
         hash(key)               # Raise TypeError if unhashable
         return self._cache.get(key=key, default=default, version=version)
+
+    def get_many(self, keys, version=None):
+        """Returns a dict of the keys found, with their values."""
+        return self._cache.get_many(keys, version=version)
+
+    def set_many(self, mapping, version=None):
+        """Sets all the keys and values of ``mapping``."""
+        self._cache.set_many(mapping, version=version)
@@ -0,0 +1,22 @@
+from __future__ import print_function
+from __future__ import unicode_literals
+from __future__ import absolute_import
+
+from django.core.management.base import BaseCommand
+
+from multisite.resolvers import dump_snapshot
+
+
+class Command(BaseCommand):
+    help = ('Writes every Alias and its Site to a snapshot file for '
+            'multisite.resolvers.SnapshotFileResolver.')
+
+    def add_arguments(self, parser):
+        parser.add_argument('path', help='The snapshot file to write.')
+
+    def handle(self, **options):
+        count = dump_snapshot(options['path'])
+        if options.get('verbosity', 1) >= 1:
+            self.stdout.write('%d aliases written to %s' % (
+                count, options['path']
+            ))
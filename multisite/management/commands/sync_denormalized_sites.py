@@ -0,0 +1,40 @@
+from __future__ import print_function
+from __future__ import unicode_literals
+from __future__ import absolute_import
+
+import django
+from django.apps import apps
+from django.core.management.base import BaseCommand
+
+from multisite.managers import SpanningCurrentSiteManager
+
+
+class Command(BaseCommand):
+    help = ('Copies the Site reached by each SpanningCurrentSiteManager '
+            'into its site_field_name field.')
+
+    def add_arguments(self, parser):
+        parser.add_argument('app_label', nargs='*',
+                            help='Only sync models of these apps.')
+
+    def handle(self, **options):
+        app_labels = options.get('app_label')
+        for model in apps.get_models():
+            opts = model._meta
+            if app_labels and opts.app_label not in app_labels:
+                continue
+            if django.VERSION < (1, 10):
+                # (creation_counter, manager, abstract) tuples
+                managers = [manager for _, manager, _ in opts.managers]
+            else:
+                managers = opts.managers
+            for manager in managers:
+                if not isinstance(manager, SpanningCurrentSiteManager) or \
+                   manager.site_field_name is None:
+                    continue
+                updated = manager.sync_site_field()
+                if options.get('verbosity', 1) >= 1:
+                    self.stdout.write('%s.%s.%s: %d updated' % (
+                        opts.app_label, opts.object_name,
+                        manager.site_field_name, updated
+                    ))
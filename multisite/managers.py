@@ -2,10 +2,13 @@
 from __future__ import unicode_literals
 from __future__ import absolute_import
 
+from django.conf import settings
+from django.core import checks
 from django.db import models
+from django.db.models.signals import pre_save
 from django.contrib.sites import managers
 from django.db.models.fields import FieldDoesNotExist
-from django.db.models.sql import constants
+from django.db.models.constants import LOOKUP_SEP
 
 
 class SpanningCurrentSiteManager(managers.CurrentSiteManager):
@@ -20,44 +23,200 @@ class SpanningCurrentSiteManager(managers.CurrentSiteManager):
 
         on_site = SpanningCurrentSiteManager("family__site")
 
-    and it will do the proper thing."""
+    and it will do the proper thing.
 
-    def _validate_field_name(self):
-        """Given the field identifier, goes down the chain to check that
-        each specified field
-            a) exists,
-            b) is of type ForeignKey or ManyToManyField
+    The field chain is validated once per model, by the system checks or on
+    first use. When it ends in a ForeignKey, queries filter on its column
+    (family__site_id) instead of joining django_site.
 
-        If no field name is specified when instantiating
-        SpanningCurrentSiteManager, it tries to find either 'site' or
-        'sites' as the site link, much like CurrentSiteManager does.
-        """
+    To avoid the joins altogether, Layer can store a copy of the Site in a
+    ForeignKey of its own, named by ``site_field_name``:
+
+        site = models.ForeignKey(Site, null=True, editable=False,
+                                 related_name='+', on_delete=models.CASCADE)
+        on_site = SpanningCurrentSiteManager("family__site",
+                                             site_field_name="site")
+
+    The manager then filters on that column. It is set whenever a Layer is
+    saved; when a LayerFamily moves to another Site, run the
+    sync_denormalized_sites management command, or sync_site_field()."""
+
+    # Lookups to filter on the current Site, by (model, field name)
+    _site_lookups = {}
+    # Denormalized Site fields, by (model, field name, site field name)
+    _site_fields = {}
+
+    def __init__(self, field_name=None, site_field_name=None):
+        super(SpanningCurrentSiteManager, self).__init__(field_name)
+        self.site_field_name = site_field_name
+
+    def contribute_to_class(self, model, name):
+        super(SpanningCurrentSiteManager, self).contribute_to_class(model,
+                                                                    name)
+        opts = model._meta
+        if self.site_field_name is not None and not opts.abstract:
+            pre_save.connect(self._update_site_field, sender=model,
+                             weak=False,
+                             dispatch_uid=('%s.%s' % (opts.app_label,
+                                                      opts.model_name),
+                                           name))
+
+    def check(self, **kwargs):
+        errors = super(managers.CurrentSiteManager, self).check(**kwargs)
+        errors.extend(self._check_field_name())
+        return errors
+
+    def _check_field_name(self):
+        try:
+            self._get_chain_lookup()
+        except (TypeError, ValueError) as e:
+            return [checks.Error(str(e), obj=self, id='multisite.E001')]
+        if self.site_field_name is not None:
+            try:
+                self._get_site_field()
+            except (TypeError, ValueError) as e:
+                return [checks.Error(str(e), obj=self, id='multisite.E002')]
+        return []
+
+    def _get_field_name(self):
+        """Returns the field name, guessing either 'site' or 'sites' if none
+        was specified when instantiating SpanningCurrentSiteManager, much
+        like CurrentSiteManager does."""
         if self._CurrentSiteManager__field_name is None:
-            # Guess at field name
-            field_names = self.model._meta.get_all_field_names()
             for potential_name in ['site', 'sites']:
-                if potential_name in field_names:
-                    self._CurrentSiteManager__field_name = potential_name
-                    break
+                try:
+                    self.model._meta.get_field(potential_name)
+                except FieldDoesNotExist:
+                    continue
+                self._CurrentSiteManager__field_name = potential_name
+                break
             else:
                 raise ValueError(
                     "%s couldn't find a field named either 'site' or 'sites' "
                     "in %s." %
                     (self.__class__.__name__, self.model._meta.object_name)
                 )
+        return self._CurrentSiteManager__field_name
 
-        fieldname_chain = self._CurrentSiteManager__field_name.split(
-            constants.LOOKUP_SEP
+    def get_site_lookup(self):
+        """Returns the lookup that filters this model on a Site's id."""
+        if self.site_field_name is not None:
+            return self._get_site_field().attname
+        return self._get_chain_lookup()
+
+    def _get_chain_lookup(self):
+        """Returns the lookup that follows the field chain to a Site's id,
+        validating the chain the first time it is used for the model."""
+        field_name = self._get_field_name()
+        key = (self.model, field_name)
+        lookup = self._site_lookups.get(key)
+        if lookup is None:
+            field = self._validate_field_name()
+            if field.many_to_many:
+                lookup = field_name
+            else:
+                # Filter on the foreign key column, without joining the Site
+                lookup = LOOKUP_SEP.join(
+                    field_name.split(LOOKUP_SEP)[:-1] +
+                    [field.attname]
+                )
+            self._site_lookups[key] = lookup
+        return lookup
+
+    def get_queryset(self):
+        return super(managers.CurrentSiteManager, self).get_queryset().filter(
+            **{self.get_site_lookup(): settings.SITE_ID}
         )
+
+    def _get_site_field(self):
+        """Returns the denormalized Site field, checking that the chain can
+        be copied into it the first time it is used for the model."""
+        self._get_chain_lookup()
+        key = (self.model, self._get_field_name(), self.site_field_name)
+        field = self._site_fields.get(key)
+        if field is not None:
+            return field
+        model = self.model
+        for fieldname in self._get_field_name().split(LOOKUP_SEP):
+            if model._meta.get_field(fieldname).many_to_many:
+                raise TypeError(
+                    "%s can only copy the Site of a chain of ForeignKeys." %
+                    self.__class__.__name__
+                )
+            model = self._get_related_model(model, fieldname)
+        field = self._validate_single_field_name(self.model,
+                                                 self.site_field_name)
+        if field.many_to_many:
+            raise TypeError("Field %r must be a ForeignKey."
+                            % self.site_field_name)
+        self._site_fields[key] = field
+        return field
+
+    def get_site_id(self, instance):
+        """Returns the id of the Site that ``instance`` reaches through the
+        field chain, in at most one query."""
+        lookup = self._get_chain_lookup().split(LOOKUP_SEP)
+        if len(lookup) == 1:
+            return getattr(instance, lookup[0])
+        field = self.model._meta.get_field(lookup[0])
+        value = getattr(instance, field.attname)
+        if value is None:
+            return None
+        related_model = self._get_related_model(self.model, lookup[0])
+        try:
+            target_field = field.remote_field.get_related_field()
+        except AttributeError:
+            target_field = field.rel.get_related_field()
+        return related_model._base_manager.filter(
+            **{target_field.attname: value}
+        ).values_list(LOOKUP_SEP.join(lookup[1:]), flat=True).first()
+
+    def _update_site_field(self, sender, instance, raw=False, **kwargs):
+        if raw:
+            return
+        setattr(instance, self._get_site_field().attname,
+                self.get_site_id(instance))
+
+    def sync_site_field(self):
+        """Copies the Site reached through the field chain into the
+        denormalized Site field, wherever they differ. Returns the number
+        of updated objects."""
+        attname = self._get_site_field().attname
+        lookup = self._get_chain_lookup()
+        qset = self.model._base_manager.order_by()
+        updated = 0
+        site_ids = qset.values_list(lookup, flat=True).distinct()
+        for site_id in list(site_ids):
+            if site_id is None:
+                stale = qset.filter(**{lookup + '__isnull': True}).exclude(
+                    **{attname + '__isnull': True}
+                )
+            else:
+                stale = qset.filter(**{lookup: site_id}).exclude(
+                    **{attname: site_id}
+                )
+            updated += stale.update(**{attname: site_id})
+        return updated
+
+    def _validate_field_name(self):
+        """Given the field identifier, goes down the chain to check that
+        each specified field
+            a) exists,
+            b) is of type ForeignKey or ManyToManyField
+
+        Returns the last field of the chain.
+        """
+        fieldname_chain = self._get_field_name().split(LOOKUP_SEP)
         model = self.model
 
         for fieldname in fieldname_chain:
             # Throws an exception if anything goes bad
-            self._validate_single_field_name(model, fieldname)
+            field = self._validate_single_field_name(model, fieldname)
             model = self._get_related_model(model, fieldname)
 
         # If we get this far without an exception, everything is good
         self._CurrentSiteManager__is_validated = True
+        return field
 
     def _validate_single_field_name(self, model, field_name):
         """Checks if the given fieldname can be used to make a link between a
@@ -77,6 +236,7 @@ class SpanningCurrentSiteManager(managers.CurrentSiteManager):
                 "Couldn't find a field named %r in %s." %
                 (field_name, model._meta.object_name)
             )
+        return field
 
     def _get_related_model(self, model, fieldname):
         """Given a model and the name of a ForeignKey or ManyToManyField column
@@ -0,0 +1,254 @@
+# -*- coding: utf-8 -*-
+from __future__ import unicode_literals
+from __future__ import absolute_import
+
+import logging
+import socket
+import threading
+import time
+from collections import defaultdict
+
+from django.conf import settings
+from django.core.exceptions import ImproperlyConfigured
+from django.core.signals import setting_changed
+from django.db import connections
+from django.dispatch import receiver
+from django.utils.module_loading import import_string
+
+from .signals import alias_resolved, canonical_redirect, fallback_invoked
+
+try:
+    # Django > 1.10 uses MiddlewareMixin
+    from django.utils.deprecation import MiddlewareMixin
+except ImportError:
+    MiddlewareMixin = object
+
+
+class MetricsSink(object):
+    """
+    Receives counters and timings, named like StatsD metrics.
+
+    Subclasses send them somewhere.
+    """
+
+    def incr(self, name, value=1):
+        """Adds ``value`` to the counter ``name``."""
+        raise NotImplementedError
+
+    def timing(self, name, value):
+        """Records ``value`` milliseconds for the timer ``name``."""
+        raise NotImplementedError
+
+
+class LoggingSink(MetricsSink):
+    """Logs metrics in the StatsD line format."""
+
+    def __init__(self, logger='multisite.metrics', level=logging.INFO):
+        self.logger = logging.getLogger(logger)
+        self.level = level
+
+    def incr(self, name, value=1):
+        self.logger.log(self.level, '%s:%d|c', name, value)
+
+    def timing(self, name, value):
+        self.logger.log(self.level, '%s:%.3f|ms', name, value)
+
+
+class StatsdSink(MetricsSink):
+    """Sends metrics to a StatsD server over UDP."""
+
+    def __init__(self, host='localhost', port=8125, prefix=''):
+        self.address = (host, int(port))
+        self.prefix = prefix
+        self.socket = socket.socket(socket.AF_INET, socket.SOCK_DGRAM)
+
+    def send(self, data):
+        try:
+            self.socket.sendto(data.encode('utf-8'), self.address)
+        except (socket.error, OSError):
+            # Losing metrics is better than failing the request
+            pass
+
+    def incr(self, name, value=1):
+        self.send('%s%s:%d|c' % (self.prefix, name, value))
+
+    def timing(self, name, value):
+        self.send('%s%s:%.3f|ms' % (self.prefix, name, value))
+
+
+class MemorySink(MetricsSink):
+    """Keeps metrics in memory, e.g. for tests."""
+
+    def __init__(self):
+        self._lock = threading.Lock()
+        self.clear()
+
+    def incr(self, name, value=1):
+        with self._lock:
+            self.counters[name] += value
+
+    def timing(self, name, value):
+        with self._lock:
+            self.timings[name].append(value)
+
+    def clear(self):
+        with self._lock:
+            self.counters = defaultdict(int)
+            self.timings = defaultdict(list)
+
+
+_sink = None
+_sink_lock = threading.Lock()
+
+
+def get_sink():
+    """
+    Returns the sink configured in ``settings.MULTISITE_METRICS_SINK``, or
+    None if metrics are disabled.
+
+    ``MULTISITE_METRICS_SINK`` is a MetricsSink class or its dotted path,
+    instantiated once with ``settings.MULTISITE_METRICS_SINK_KWARGS``.
+    """
+    global _sink
+    if _sink is None:
+        with _sink_lock:
+            if _sink is None:
+                _sink = _create_sink() or False
+    return _sink or None
+
+
+def _create_sink():
+    sink_class = getattr(settings, 'MULTISITE_METRICS_SINK', None)
+    if sink_class is None:
+        return None
+    if not callable(sink_class):
+        try:
+            sink_class = import_string(sink_class)
+        except ImportError:
+            raise ImproperlyConfigured(
+                'settings.MULTISITE_METRICS_SINK is not callable: %s' %
+                sink_class
+            )
+    kwargs = getattr(settings, 'MULTISITE_METRICS_SINK_KWARGS', {})
+    return sink_class(**kwargs)
+
+
+def reset_sink(setting=None, **kwargs):
+    """Forgets the configured sink, so that the next metric recreates it."""
+    global _sink
+    if setting is None or setting.startswith('MULTISITE_METRICS_'):
+        _sink = None
+
+
+setting_changed.connect(reset_sink)
+
+
+def site_metric(site_id, name):
+    """Returns the name of the metric ``name`` for the Site ``site_id``."""
+    if site_id is None:
+        site_id = 'unknown'
+    return 'multisite.site.%s.%s' % (site_id, name)
+
+
+def elapsed_ms(start):
+    """Returns the milliseconds elapsed since ``start``."""
+    return (time.time() - start) * 1000
+
+
+class QueryStats(object):
+    """
+    Counts and times the database queries of the current thread, while it
+    is installed as an execute wrapper (Django >= 2.0).
+    """
+
+    def __init__(self):
+        self.count = 0
+        self.duration = 0.0
+        self.connections = []
+
+    def __call__(self, execute, sql, params, many, context):
+        start = time.time()
+        try:
+            return execute(sql, params, many, context)
+        finally:
+            self.count += 1
+            self.duration += elapsed_ms(start)
+
+    def install(self):
+        for connection in connections.all():
+            if hasattr(connection, 'execute_wrappers'):
+                connection.execute_wrappers.append(self)
+                self.connections.append(connection)
+
+    def uninstall(self):
+        while self.connections:
+            connection = self.connections.pop()
+            if self in connection.execute_wrappers:
+                connection.execute_wrappers.remove(self)
+
+
+class SiteMetricsMiddleware(MiddlewareMixin):
+    """
+    Records, for the Site of each request: the number of requests, their
+    duration, their database queries and the time spent in them, and
+    whether DynamicSiteMiddleware found the Alias in its cache.
+
+    Put it before DynamicSiteMiddleware, so that the queries resolving the
+    Site are counted too. Does nothing unless
+    ``settings.MULTISITE_METRICS_SINK`` is set.
+    """
+
+    def process_request(self, request):
+        if get_sink() is None:
+            return
+        stats = QueryStats()
+        stats.install()
+        request._multisite_metrics = (time.time(), stats)
+
+    def process_response(self, request, response):
+        metrics = getattr(request, '_multisite_metrics', None)
+        if metrics is None:
+            return response
+        del request._multisite_metrics
+        start, stats = metrics
+        stats.uninstall()
+
+        sink = get_sink()
+        if sink is None:
+            return response
+        site_id = getattr(settings.SITE_ID, 'site_id', settings.SITE_ID)
+        sink.incr(site_metric(site_id, 'requests'))
+        sink.timing(site_metric(site_id, 'request_time'), elapsed_ms(start))
+        sink.incr(site_metric(site_id, 'db.queries'), stats.count)
+        sink.timing(site_metric(site_id, 'db.time'), stats.duration)
+        cache_hit = getattr(request, '_multisite_alias_cache_hit', None)
+        if cache_hit is not None:
+            sink.incr(site_metric(site_id,
+                                  'alias_cache.%s' % ('hit' if cache_hit
+                                                      else 'miss')))
+        return response
+
+
+@receiver(alias_resolved)
+def record_alias_resolved(sender, alias, source, duration, **kwargs):
+    sink = get_sink()
+    if sink is None:
+        return
+    name = 'multisite.alias.%s' % (source if alias is not None
+                                   else 'not_found')
+    sink.incr(name)
+    sink.timing(name + '.time', duration)
+
+
+@receiver(fallback_invoked)
+def record_fallback_invoked(sender, reason, **kwargs):
+    sink = get_sink()
+    if sink is not None:
+        sink.incr('multisite.fallback.%s' % reason)
+
+
+@receiver(canonical_redirect)
+def record_canonical_redirect(sender, **kwargs):
+    sink = get_sink()
+    if sink is not None:
+        sink.incr('multisite.redirect')
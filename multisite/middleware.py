@@ -2,8 +2,11 @@
 from __future__ import unicode_literals
 from __future__ import absolute_import
 
+import logging
 import os
 import tempfile
+import threading
+import time
 try:
     from urlparse import urlsplit, urlunsplit
 except ImportError:
@@ -16,6 +19,7 @@ from django.core.exceptions import DisallowedHost
 from django.core import mail
 
 from django.core.cache import caches
+from django.db import connections
 
 try:
     # Django > 1.10 uses MiddlewareMixin
@@ -33,13 +37,23 @@ except ImportError:
 
 from django.db.models.signals import pre_save, post_delete, post_init
 from django.http import Http404, HttpResponsePermanentRedirect
+from django.utils.functional import SimpleLazyObject
 
 from hashlib import md5 as md5_constructor
 
+from .metrics import elapsed_ms
 from .models import Alias
+from .resolvers import get_resolver
+from .signals import alias_resolved, canonical_redirect, fallback_invoked
+
+
+logger = logging.getLogger('multisite')
 
 
 class DynamicSiteMiddleware(MiddlewareMixin):
+    # Seconds for which one request or thread refreshes a stale Alias, at most
+    lease_timeout = 10
+
     def __init__(self, *args, **kwargs):
         super(DynamicSiteMiddleware, self).__init__(*args, **kwargs)
         if not hasattr(settings.SITE_ID, 'set'):
@@ -55,6 +69,14 @@ class DynamicSiteMiddleware(MiddlewareMixin):
         )
 
         self.cache = caches[self.cache_alias]
+        self.soft_timeout = getattr(settings, 'CACHE_MULTISITE_SOFT_TIMEOUT',
+                                    None)
+        self.refresh = getattr(settings, 'CACHE_MULTISITE_REFRESH', 'lease')
+        if self.refresh not in ('lease', 'thread'):
+            raise ImproperlyConfigured(
+                'Invalid CACHE_MULTISITE_REFRESH: %r' % self.refresh
+            )
+        self.resolver = get_resolver()
         post_init.connect(self.site_domain_cache_hook, sender=Site,
                           dispatch_uid='multisite_post_init')
         pre_save.connect(self.site_domain_changed_hook, sender=Site)
@@ -108,16 +130,87 @@ class DynamicSiteMiddleware(MiddlewareMixin):
         """
         host, port = self.netloc_parse(netloc)
 
+        start = time.time()
         try:
-            alias = Alias.objects.resolve(host=host, port=port)
+            alias = self.resolver.resolve(host=host, port=port)
         except ValueError:
             alias = None
+        source = self.resolver.source
 
         if alias is None:
             # Running under TestCase or runserver?
-            return self.get_development_alias(netloc)
+            alias = self.get_development_alias(netloc)
+            if alias is not None:
+                source = 'development'
+
+        alias_resolved.send(sender=self.__class__, netloc=netloc, alias=alias,
+                            source=source, duration=elapsed_ms(start))
         return alias
 
+    def get_cached_alias(self, cache_key):
+        """
+        Returns ``(alias, stale)`` for the Alias in the cache, or
+        ``(None, False)``.
+
+        With ``settings.CACHE_MULTISITE_SOFT_TIMEOUT``, an Alias is stale
+        once it has been cached for longer than that many seconds.
+        """
+        entry = self.cache.get(cache_key)
+        if isinstance(entry, tuple):
+            alias, soft_expires = entry
+            return alias, time.time() >= soft_expires
+        return entry, False
+
+    def set_cached_alias(self, cache_key, alias):
+        if self.soft_timeout is None:
+            self.cache.set(cache_key, alias)
+        else:
+            self.cache.set(cache_key,
+                           (alias, time.time() + self.soft_timeout))
+
+    def refresh_alias(self, netloc, cache_key):
+        """Resolves ``netloc`` again, and updates the cache."""
+        alias = self.get_alias(netloc)
+        if alias is None:
+            self.cache.delete(cache_key)
+        else:
+            self.set_cached_alias(cache_key, alias)
+
+    def refresh_stale_alias(self, netloc, cache_key):
+        """
+        Refreshes a stale Alias, unless another request or thread already is.
+
+        Depending on ``settings.CACHE_MULTISITE_REFRESH``, the Alias is
+        refreshed by this request ('lease', the default), or by a
+        background thread ('thread'). Errors are logged, and the stale Alias
+        is served until the hard timeout of the cache. The lease is left to
+        expire, so that a failing lookup is not retried by every request.
+        """
+        lease_key = cache_key + '.lease'
+        if not self.cache.add(lease_key, True,
+                              timeout=min(self.lease_timeout,
+                                          self.soft_timeout)):
+            return
+        if self.refresh == 'thread':
+            thread = threading.Thread(target=self._refresh_in_thread,
+                                      args=(netloc, cache_key))
+            thread.daemon = True
+            thread.start()
+        else:
+            self._refresh(netloc, cache_key)
+
+    def _refresh(self, netloc, cache_key):
+        try:
+            self.refresh_alias(netloc, cache_key)
+        except Exception:
+            logger.exception('Failed to refresh the Alias of %s', netloc)
+
+    def _refresh_in_thread(self, netloc, cache_key):
+        try:
+            self._refresh(netloc, cache_key)
+        finally:
+            connections.close_all()
+
     def fallback_view(self, request):
         """
         Runs the fallback view function in ``settings.MULTISITE_FALLBACK``.
@@ -170,6 +263,8 @@ class DynamicSiteMiddleware(MiddlewareMixin):
         url = urlunsplit((url.scheme,
                           alias.site.domain,
                           url.path, url.query, url.fragment))
+        canonical_redirect.send(sender=self.__class__, request=request,
+                                alias=alias)
         return HttpResponsePermanentRedirect(url)
 
     def process_request(self, request):
@@ -177,15 +272,33 @@ class DynamicSiteMiddleware(MiddlewareMixin):
             netloc = request.get_host().lower()
         except DisallowedHost:
             settings.SITE_ID.reset()
+            fallback_invoked.send(sender=self.__class__, request=request,
+                                  netloc=None, reason='disallowed_host')
             return self.fallback_view(request)
 
         cache_key = self.get_cache_key(netloc)
 
         # Find the Alias in the cache
-        alias = self.cache.get(cache_key)
+        start = time.time()
+        alias, stale = self.get_cached_alias(cache_key)
+        request._multisite_alias_cache_hit = alias is not None
         if alias is not None:
-            self.cache.set(cache_key, alias)
-            settings.SITE_ID.set(alias.site_id)
+            alias_resolved.send(sender=self.__class__, netloc=netloc,
+                                alias=alias,
+                                source='stale' if stale else 'cache',
+                                duration=elapsed_ms(start))
+            if stale:
+                # Serve the stale Alias while it is refreshed
+                self.refresh_stale_alias(netloc, cache_key)
+            elif self.soft_timeout is None:
+                self.cache.set(cache_key, alias)
+            # Site.objects.get_current() will memoize the Site
+            settings.SITE_ID.set(alias.site_id, memoize=True)
+            # Bound to the Alias, whatever SITE_ID is when it is evaluated
+            site_id = alias.site_id
+            request.site = SimpleLazyObject(
+                lambda: Site.objects._get_site_by_id(site_id)
+            )
             return self.redirect_to_canonical(request, alias)
 
         # Cache missed
@@ -194,11 +307,14 @@ class DynamicSiteMiddleware(MiddlewareMixin):
         # Fallback using settings.MULTISITE_FALLBACK
         if alias is None:
             settings.SITE_ID.reset()
+            fallback_invoked.send(sender=self.__class__, request=request,
+                                  netloc=netloc, reason='unknown_host')
             return self.fallback_view(request)
 
         # Found Site
-        self.cache.set(cache_key, alias)
-        settings.SITE_ID.set(alias.site_id)
+        self.set_cached_alias(cache_key, alias)
+        settings.SITE_ID.set_site(alias.site)
+        request.site = alias.site
         SITE_CACHE[settings.SITE_ID] = alias.site  # Pre-populate SITE_CACHE
         return self.redirect_to_canonical(request, alias)
 
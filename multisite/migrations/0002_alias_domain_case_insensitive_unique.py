@@ -0,0 +1,42 @@
+# -*- coding: utf-8 -*-
+from __future__ import unicode_literals
+from __future__ import absolute_import
+
+from django.db import migrations
+
+
+# Same values as multisite.models, frozen for this migration
+DOMAIN_INDEX_NAME = 'multisite_alias_domain_ci'
+DOMAIN_INDEX_VENDORS = ('oracle', 'postgresql', 'sqlite')
+
+
+def create_domain_index(apps, schema_editor):
+    if schema_editor.connection.vendor not in DOMAIN_INDEX_VENDORS:
+        return
+    Alias = apps.get_model('multisite', 'Alias')
+    schema_editor.execute(
+        'CREATE UNIQUE INDEX %s ON %s (LOWER(%s))' % (
+            schema_editor.quote_name(DOMAIN_INDEX_NAME),
+            schema_editor.quote_name(Alias._meta.db_table),
+            schema_editor.quote_name(Alias._meta.get_field('domain').column),
+        )
+    )
+
+
+def drop_domain_index(apps, schema_editor):
+    if schema_editor.connection.vendor not in DOMAIN_INDEX_VENDORS:
+        return
+    schema_editor.execute(
+        'DROP INDEX %s' % schema_editor.quote_name(DOMAIN_INDEX_NAME)
+    )
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('multisite', '0001_initial'),
+    ]
+
+    operations = [
+        migrations.RunPython(create_domain_index, drop_domain_index),
+    ]
@@ -2,15 +2,18 @@ from __future__ import unicode_literals
 from __future__ import absolute_import
 
 import operator
+import sys
 from functools import reduce
 
 from django.contrib.sites.models import Site
 from django.core.exceptions import ValidationError
 from django.core.validators import validate_ipv4_address
-from django.db import connections, models, router
+from django.db import (IntegrityError, connections, models, router,
+                       transaction)
 from django.db.models import Q
 from django.db.models.signals import pre_save, post_save
 from django.db.models.signals import post_migrate
+from django.utils import six
 from django.utils.encoding import python_2_unicode_compatible
 from django.utils.translation import ugettext_lazy as _
 
@@ -23,8 +26,19 @@ except NameError:  # python3
 
 _site_domain = Site._meta.get_field('domain')
 
+# Unique index on LOWER(Alias.domain), created by migrations on these database
+# vendors. Elsewhere, case-insensitive uniqueness is only checked in Python.
+DOMAIN_INDEX_NAME = 'multisite_alias_domain_ci'
+DOMAIN_INDEX_VENDORS = ('oracle', 'postgresql', 'sqlite')
+
 use_framework_for_site_cache()
 
+# Databases where the Alias table is known to exist
+_db_table_created = set()
+
+# Whether each database has the DOMAIN_INDEX_NAME index, by database alias
+_domain_index_exists = {}
+
 
 class AliasManager(models.Manager):
     """Manager for all Aliases."""
@@ -111,15 +125,19 @@ class CanonicalAliasManager(models.Manager):
         Alias objects::
 
             Alias.canonical.sync_many(site__domain='example.com')
+
+        With ``validate=False``, the Alias objects are saved without
+        running ``full_clean()``; see ``Alias.save()``.
         """
+        validate = kwargs.pop('validate', True)
         aliases = self.get_queryset().filter(*args, **kwargs)
         for alias in aliases.select_related('site'):
             domain = alias.site.domain
             if domain and alias.domain != domain:
                 alias.domain = domain
-                alias.save()
+                alias.save(validate=validate)
 
-    def sync_missing(self):
+    def sync_missing(self, validate=True):
         """Create missing canonical Alias objects based on Site.domain."""
         aliases = self.get_queryset()
         try:
@@ -127,12 +145,12 @@ class CanonicalAliasManager(models.Manager):
         except AttributeError:
             sites = self.model._meta.get_field('site').rel.to
         for site in sites.objects.exclude(aliases__in=aliases):
-            Alias.sync(site=site)
+            Alias.sync(site=site, force_insert=True, validate=validate)
 
-    def sync_all(self):
+    def sync_all(self, validate=True):
         """Create or sync canonical Alias objects from all Site objects."""
-        self.sync_many()
-        self.sync_missing()
+        self.sync_many(validate=validate)
+        self.sync_missing(validate=validate)
 
 
 class NotCanonicalAliasManager(models.Manager):
@@ -194,8 +212,29 @@ class Alias(models.Model):
     def __repr__(self):
         return '<Alias: %s>' % str(self)
 
+    def save(self, *args, **kwargs):
+        """
+        Validates and saves the Alias.
+
+        Pass ``validate=False`` to skip ``full_clean()`` for data that is
+        already known to be valid, e.g. when provisioning in bulk. The
+        database constraints still reject duplicate domains, but with an
+        IntegrityError instead of a ValidationError.
+        """
+        self._validate_on_save = kwargs.pop('validate', True)
+        try:
+            super(Alias, self).save(*args, **kwargs)
+        finally:
+            del self._validate_on_save
+
     def save_base(self, *args, **kwargs):
-        self.full_clean()
+        using = kwargs.get('using') or router.db_for_write(self.__class__,
+                                                            instance=self)
+        validate = getattr(self, '_validate_on_save', True)
+        # Let the database check uniqueness, instead of querying first
+        db_unique = validate and self._has_domain_index(using)
+        if validate:
+            self.full_clean(validate_unique=not db_unique)
         # For canonical Alias, domains must match Site domains.
         # This needs to be validated here so that it is executed *after* the
         # Site pre-save signal updates the domain (an AliasInline modelform
@@ -205,33 +244,76 @@ class Alias(models.Model):
             raise ValidationError(
                 {'domain': ['Does not match %r' % self.site]}
             )
-        super(Alias, self).save_base(*args, **kwargs)
+        if not db_unique:
+            super(Alias, self).save_base(*args, **kwargs)
+            return
+
+        try:
+            with transaction.atomic(using=using):
+                super(Alias, self).save_base(*args, **kwargs)
+        except IntegrityError:
+            exc_info = sys.exc_info()
+            # Report the violated constraint like full_clean() would
+            self.validate_unique(exclude=[])
+            six.reraise(*exc_info)
+
+    @classmethod
+    def _has_domain_index(cls, using):
+        """
+        Returns True if the database enforces case-insensitive uniqueness
+        of Alias.domain, i.e. if migrations created the index. This is
+        checked once per database, and again after migrating.
+        """
+        exists = _domain_index_exists.get(using)
+        if exists is None:
+            connection = connections[using]
+            exists = False
+            if connection.vendor in DOMAIN_INDEX_VENDORS:
+                with connection.cursor() as cursor:
+                    constraints = connection.introspection.get_constraints(
+                        cursor, cls._meta.db_table
+                    )
+                exists = DOMAIN_INDEX_NAME in constraints
+            _domain_index_exists[using] = exists
+        return exists
 
     def validate_unique(self, exclude=None):
         errors = {}
+        check_domain = exclude is not None and 'domain' not in exclude
+        if check_domain:
+            # The case-insensitive check below also covers the exact one
+            exclude = list(exclude) + ['domain']
         try:
             super(Alias, self).validate_unique(exclude=exclude)
         except ValidationError as e:
             errors = e.update_error_dict(errors)
 
-        if exclude is not None and 'domain' not in exclude:
+        if check_domain and not self._domain_validated():
             # Ensure domain is unique, insensitive to case
             field_name = 'domain'
-            field_error = self.unique_error_message(self.__class__,
-                                                    (field_name,))
-            if field_name not in errors or \
-               str(field_error) not in [str(err) for err in errors[field_name]]:
-                qset = self.__class__.objects.filter(
-                    **{field_name + '__iexact': getattr(self, field_name)}
-                )
-                if self.pk is not None:
-                    qset = qset.exclude(pk=self.pk)
-                if qset.exists():
-                    errors.setdefault(field_name, []).append(field_error)
+            qset = self.__class__.objects.filter(
+                **{field_name + '__iexact': getattr(self, field_name)}
+            )
+            if self.pk is not None:
+                qset = qset.exclude(pk=self.pk)
+            if qset.exists():
+                field_error = self.unique_error_message(self.__class__,
+                                                        (field_name,))
+                errors.setdefault(field_name, []).append(field_error)
 
         if errors:
             raise ValidationError(errors)
 
+    def _domain_validated(self):
+        """
+        Returns True if SiteForm has already checked that no other Alias
+        uses the domain of this canonical Alias.
+        """
+        if not self.is_canonical or self.site_id is None or not self.domain:
+            return False
+        validated = getattr(self.site, '_alias_domain_validated', None)
+        return validated == self.domain.lower()
+
     @classmethod
     def _sync_blank_domain(cls, site):
         """Delete associated Alias object for ``site``, if domain is blank."""
@@ -254,11 +336,12 @@ class Alias(models.Model):
             alias.delete()
 
     @classmethod
-    def sync(cls, site, force_insert=False):
+    def sync(cls, site, force_insert=False, validate=True):
         """
         Create or synchronize Alias object from ``site``.
 
         If `force_insert`, forces creation of Alias object.
+        If not `validate`, the Alias is saved without ``full_clean()``.
         """
         domain = site.domain
         if not domain:
@@ -266,18 +349,32 @@ class Alias(models.Model):
             return
 
         if force_insert:
-            alias = cls.objects.create(site=site, is_canonical=True,
-                                       domain=domain)
+            alias = cls(site=site, is_canonical=True, domain=domain)
+            alias.save(force_insert=True, validate=validate)
+            return alias
 
-        else:
-            alias, created = cls.objects.get_or_create(
-                site=site, is_canonical=True,
-                defaults={'domain': domain}
-            )
-            if not created and alias.domain != domain:
-                alias.site = site
-                alias.domain = domain
-                alias.save()
+        try:
+            alias = cls.objects.get(site=site, is_canonical=True)
+        except cls.DoesNotExist:
+            alias = cls(site=site, is_canonical=True, domain=domain)
+            try:
+                with transaction.atomic(using=router.db_for_write(cls)):
+                    alias.save(force_insert=True, validate=validate)
+                return alias
+            except (IntegrityError, ValidationError):
+                # Created concurrently, like QuerySet.get_or_create(). With
+                # validation, save() reports the conflict as a
+                # ValidationError.
+                exc_info = sys.exc_info()
+                try:
+                    alias = cls.objects.get(site=site, is_canonical=True)
+                except cls.DoesNotExist:
+                    six.reraise(*exc_info)
+
+        if alias.domain != domain:
+            alias.site = site
+            alias.domain = domain
+            alias.save(validate=validate)
 
         return alias
 
@@ -306,9 +403,11 @@ class Alias(models.Model):
         # When running create_default_site() because of post_syncdb,
         # don't try to sync before the db_table has been created.
         using = router.db_for_write(cls)
-        tables = connections[using].introspection.table_names()
-        if cls._meta.db_table not in tables:
-            return
+        if using not in _db_table_created:
+            tables = connections[using].introspection.table_names()
+            if cls._meta.db_table not in tables:
+                return
+            _db_table_created.add(using)
 
         # Update Alias.domain to match site
         cls.sync(site=instance)
@@ -316,6 +415,8 @@ class Alias(models.Model):
     @classmethod
     def db_table_created_hook(cls, *args, **kwargs):
         """Syncs canonical Alias objects for all existing Site objects."""
+        # Migrations may have created or dropped the domain index
+        _domain_index_exists.pop(kwargs.get('using'), None)
         Alias.canonical.sync_all()
 
 
@@ -0,0 +1,422 @@
+# -*- coding: utf-8 -*-
+from __future__ import unicode_literals
+from __future__ import absolute_import
+
+import io
+import json
+import mmap
+import os
+import tempfile
+import threading
+import time
+
+from hashlib import md5 as md5_constructor
+
+from django.conf import settings
+from django.contrib.sites.models import Site
+from django.core.cache import caches
+from django.core.exceptions import ImproperlyConfigured
+from django.db.models.signals import post_delete, post_init, post_save
+from django.utils.module_loading import import_string
+
+from .models import Alias
+
+
+class AliasResolver(object):
+    """
+    Finds the Alias of a host for DynamicSiteMiddleware.
+
+    ``source`` names the resolver in the ``alias_resolved`` signal and in
+    the ``multisite.alias.<source>`` metrics.
+    """
+
+    source = None
+
+    def resolve(self, host, port=None):
+        """
+        Returns the Alias that best matches ``host`` and ``port``, or None.
+
+        Raises ValueError if ``host`` is invalid.
+        """
+        raise NotImplementedError
+
+
+class DatabaseResolver(AliasResolver):
+    """Queries the database for each host. This is the default."""
+
+    source = 'database'
+
+    def resolve(self, host, port=None):
+        return Alias.objects.resolve(host=host, port=port)
+
+
+class MappingResolver(AliasResolver):
+    """Resolves hosts from a dict of Aliases, by lowercase domain."""
+
+    def get_aliases(self):
+        """Returns a dict of Aliases, or of their fields, by lowercase
+        domain."""
+        raise NotImplementedError
+
+    def resolve(self, host, port=None):
+        domains = Alias.objects._expand_netloc(host=host, port=port)
+        aliases = self.get_aliases()
+        for domain in domains:
+            alias = aliases.get(domain.lower())
+            if alias is not None:
+                return alias
+
+
+class SnapshotResolver(MappingResolver):
+    """
+    Keeps every Alias, and its Site, in memory.
+
+    The snapshot is loaded with one query, and reloaded when an Alias or a
+    Site is saved or deleted in this process, or after ``timeout`` seconds
+    for changes made by other processes.
+    """
+
+    source = 'snapshot'
+
+    def __init__(self, timeout=60):
+        self.timeout = timeout
+        self._aliases = None
+        self._expires = 0
+        for sender in (Alias, Site):
+            post_save.connect(self.invalidate, sender=sender)
+            post_delete.connect(self.invalidate, sender=sender)
+
+    def get_aliases(self):
+        aliases = self._aliases
+        if aliases is None or (self.timeout is not None and
+                               time.time() >= self._expires):
+            aliases = dict((alias.domain.lower(), alias)
+                           for alias in Alias.objects.all())
+            self._aliases = aliases
+            if self.timeout is not None:
+                self._expires = time.time() + self.timeout
+        return aliases
+
+    def invalidate(self, *args, **kwargs):
+        """Forgets the snapshot, so that the next lookup reloads it."""
+        self._aliases = None
+
+
+class CacheResolver(AliasResolver):
+    """
+    Looks up Aliases in a cache, without querying the database.
+
+    populate() stores every Alias in the cache. Afterwards, Aliases are
+    stored again when they or their Site are saved, and deleted with them.
+
+    ``cache`` names the cache, which must not be
+    ``settings.CACHE_MULTISITE_ALIAS``: DynamicSiteMiddleware clears that
+    one. The entries expire after ``timeout`` seconds, or never if it is
+    None.
+    """
+
+    source = 'cache_only'
+
+    def __init__(self, cache=None, timeout=None):
+        if cache is None:
+            raise ImproperlyConfigured(
+                'CacheResolver requires a cache in '
+                'settings.MULTISITE_RESOLVER_KWARGS'
+            )
+        if cache == getattr(settings, 'CACHE_MULTISITE_ALIAS', 'default'):
+            raise ImproperlyConfigured(
+                'CacheResolver requires a cache other than '
+                'settings.CACHE_MULTISITE_ALIAS: %s' % cache
+            )
+        self.key_prefix = getattr(
+            settings,
+            'CACHE_MULTISITE_KEY_PREFIX',
+            settings.CACHES[cache].get('KEY_PREFIX', '')
+        )
+        self.cache = caches[cache]
+        self.timeout = timeout
+        post_init.connect(self.alias_domain_cache_hook, sender=Alias,
+                          dispatch_uid='multisite_resolver_post_init')
+        post_save.connect(self.alias_changed_hook, sender=Alias)
+        post_delete.connect(self.alias_deleted_hook, sender=Alias)
+        post_save.connect(self.site_changed_hook, sender=Site)
+
+    def get_cache_key(self, domain):
+        """Returns a cache key based on ``domain``."""
+        domain = md5_constructor(domain.lower().encode('utf-8'))
+        return 'multisite.resolver.%s.%s' % (self.key_prefix,
+                                             domain.hexdigest())
+
+    def resolve(self, host, port=None):
+        keys = [self.get_cache_key(domain)
+                for domain in Alias.objects._expand_netloc(host=host,
+                                                           port=port)]
+        aliases = self.cache.get_many(keys)
+        for key in keys:
+            alias = aliases.get(key)
+            if alias is not None:
+                return alias
+
+    def set_many(self, aliases):
+        self.cache.set_many(
+            dict((self.get_cache_key(alias.domain), alias)
+                 for alias in aliases),
+            timeout=self.timeout
+        )
+
+    def populate(self):
+        """Stores every Alias in the cache. Returns their number."""
+        aliases = list(Alias.objects.all())
+        self.set_many(aliases)
+        return len(aliases)
+
+    @classmethod
+    def alias_domain_cache_hook(cls, sender, instance, *args, **kwargs):
+        """Caches Alias.domain in the object for alias_changed_hook."""
+        instance._resolver_domain_cache = instance.domain
+
+    def alias_changed_hook(self, sender, instance, raw, *args, **kwargs):
+        if raw:
+            return
+        original = getattr(instance, '_resolver_domain_cache', None)
+        if original and original.lower() != instance.domain.lower():
+            self.cache.delete(self.get_cache_key(original))
+        instance._resolver_domain_cache = instance.domain
+        # Store the Alias with its Site
+        self.set_many(Alias.objects.filter(pk=instance.pk))
+
+    def alias_deleted_hook(self, sender, instance, *args, **kwargs):
+        domains = set([instance.domain.lower()])
+        original = getattr(instance, '_resolver_domain_cache', None)
+        if original:
+            domains.add(original.lower())
+        self.cache.delete_many([self.get_cache_key(domain)
+                                for domain in domains])
+
+    def site_changed_hook(self, sender, instance, raw, *args, **kwargs):
+        if raw:
+            return
+        # The stored Aliases include the previous Site
+        self.set_many(Alias.objects.filter(site=instance))
+
+
+class StaticResolver(MappingResolver):
+    """
+    Resolves hosts from a JSON file that maps domains to Site ids, like::
+
+        {"example.com": 1, "*.example.com": 1, "example.org": 2}
+
+    Instead of a Site id, a domain can map to an object with the Alias
+    fields ``site``, ``is_canonical`` and ``redirect_to_canonical``. Sites
+    are looked up in SITE_CACHE.
+    """
+
+    source = 'static'
+
+    def __init__(self, path=None):
+        if path is None:
+            raise ImproperlyConfigured(
+                'StaticResolver requires a path in '
+                'settings.MULTISITE_RESOLVER_KWARGS'
+            )
+        self.path = path
+        self._aliases = self.load(path)
+
+    @classmethod
+    def load(cls, path):
+        """
+        Returns the fields of the Aliases in the file ``path``, by
+        lowercase domain.
+        """
+        with io.open(path, encoding='utf-8') as f:
+            data = json.load(f)
+        aliases = {}
+        for domain, value in data.items():
+            if not isinstance(value, dict):
+                value = {'site': value}
+            aliases[domain.lower()] = {
+                'domain': domain,
+                'site_id': int(value['site']),
+                'is_canonical': value.get('is_canonical'),
+                'redirect_to_canonical': value.get('redirect_to_canonical',
+                                                   False),
+            }
+        return aliases
+
+    def get_aliases(self):
+        return self._aliases
+
+    def resolve(self, host, port=None):
+        fields = super(StaticResolver, self).resolve(host=host, port=port)
+        if fields is not None:
+            alias = Alias(**fields)
+            alias.site = Site.objects._get_site_by_id(alias.site_id)
+            return alias
+
+
+SNAPSHOT_HEADER = b'# multisite alias snapshot 1'
+
+
+def dump_snapshot(path):
+    """
+    Writes every Alias, and its Site, to the snapshot file ``path`` for
+    SnapshotFileResolver. Returns the number of Aliases.
+
+    The file has one line per Alias and per Site, sorted, so that it can be
+    searched without being parsed::
+
+        A<TAB>domain<TAB>site id<TAB>flags
+        S<TAB>site id<TAB>domain<TAB>name as JSON
+
+    where flags contains ``c`` for the canonical Alias, and ``r`` if it
+    redirects to the canonical domain. The file is replaced atomically.
+    """
+    lines = [SNAPSHOT_HEADER]
+    sites = {}
+    for alias in Alias.objects.order_by().iterator():
+        flags = (('c' if alias.is_canonical else '') +
+                 ('r' if alias.redirect_to_canonical else ''))
+        lines.append(('A\t%s\t%d\t%s' % (
+            alias.domain.lower(), alias.site_id, flags
+        )).encode('utf-8'))
+        sites[alias.site_id] = alias.site
+    for site in sites.values():
+        lines.append(('S\t%d\t%s\t%s' % (
+            site.pk, site.domain, json.dumps(site.name)
+        )).encode('utf-8'))
+    lines.sort()
+
+    directory = os.path.dirname(os.path.abspath(path))
+    fd, tmp_path = tempfile.mkstemp(dir=directory, prefix='.multisite')
+    try:
+        with os.fdopen(fd, 'wb') as f:
+            f.write(b'\n'.join(lines) + b'\n')
+        os.chmod(tmp_path, 0o644)
+        os.rename(tmp_path, path)
+    except Exception:
+        os.remove(tmp_path)
+        raise
+    return len(lines) - len(sites) - 1
+
+
+def _find_line(data, prefix):
+    """
+    Returns the first line of the sorted lines in ``data`` that starts with
+    ``prefix``, or None.
+    """
+    lo, hi = 0, len(data)
+    # lo and hi are always the start of a line
+    while lo < hi:
+        mid = (lo + hi) // 2
+        start = data.rfind(b'\n', 0, mid) + 1
+        end = data.find(b'\n', start)
+        if end == -1:
+            end = len(data)
+        if data[start:end] < prefix:
+            lo = end + 1
+        else:
+            hi = start
+    end = data.find(b'\n', lo)
+    if end == -1:
+        end = len(data)
+    line = data[lo:end]
+    if line.startswith(prefix):
+        return line
+
+
+class SnapshotFileResolver(AliasResolver):
+    """
+    Resolves hosts from a snapshot file written by the
+    dump_alias_snapshot management command, without querying the database.
+
+    The file named by ``path`` is loaded when the resolver is created. It is
+    reloaded when its modification time changes, which is checked at most
+    every ``check_interval`` seconds. With ``use_mmap``, the file is mapped
+    into memory instead of read, so that processes share its pages.
+    """
+
+    source = 'snapshot_file'
+
+    def __init__(self, path=None, use_mmap=False, check_interval=1):
+        if path is None:
+            raise ImproperlyConfigured(
+                'SnapshotFileResolver requires a path in '
+                'settings.MULTISITE_RESOLVER_KWARGS'
+            )
+        self.path = path
+        self.use_mmap = use_mmap
+        self.check_interval = check_interval
+        self._lock = threading.Lock()
+        self._checked = time.time()
+        self._mtime, self._data = self.load()
+
+    def load(self):
+        """Returns the modification time and the contents of the file."""
+        with io.open(self.path, 'rb') as f:
+            mtime = os.fstat(f.fileno()).st_mtime
+            if self.use_mmap:
+                data = mmap.mmap(f.fileno(), 0, access=mmap.ACCESS_READ)
+            else:
+                data = f.read()
+        if data[:len(SNAPSHOT_HEADER) + 1] != SNAPSHOT_HEADER + b'\n':
+            raise ValueError('Not an alias snapshot: %s' % self.path)
+        return mtime, data
+
+    def get_data(self):
+        """Returns the contents of the file, reloading it if it changed."""
+        now = time.time()
+        if now - self._checked >= self.check_interval:
+            with self._lock:
+                if now - self._checked >= self.check_interval:
+                    self._checked = now
+                    try:
+                        if os.stat(self.path).st_mtime != self._mtime:
+                            self._mtime, self._data = self.load()
+                    except (OSError, IOError, ValueError):
+                        # Keep the previous snapshot
+                        pass
+        return self._data
+
+    def resolve(self, host, port=None):
+        domains = Alias.objects._expand_netloc(host=host, port=port)
+        data = self.get_data()
+        for domain in domains:
+            line = _find_line(
+                data, ('A\t%s\t' % domain.lower()).encode('utf-8')
+            )
+            if line is not None:
+                domain, site_id, flags = line.decode('utf-8').split('\t')[1:]
+                return Alias(
+                    domain=domain,
+                    site=self.get_site(data, site_id),
+                    is_canonical=True if 'c' in flags else None,
+                    redirect_to_canonical='r' in flags,
+                )
+
+    def get_site(self, data, site_id):
+        line = _find_line(data, ('S\t%s\t' % site_id).encode('utf-8'))
+        if line is None:
+            raise ValueError('Site %s is missing from %s' % (site_id,
+                                                             self.path))
+        site_id, domain, name = line.decode('utf-8').split('\t')[1:]
+        return Site(id=int(site_id), domain=domain, name=json.loads(name))
+
+
+def get_resolver():
+    """
+    Returns a new instance of the resolver in
+    ``settings.MULTISITE_RESOLVER``, which is an AliasResolver class or its
+    dotted path, instantiated with ``settings.MULTISITE_RESOLVER_KWARGS``.
+    """
+    resolver_class = getattr(settings, 'MULTISITE_RESOLVER',
+                             DatabaseResolver)
+    if not callable(resolver_class):
+        try:
+            resolver_class = import_string(resolver_class)
+        except ImportError:
+            raise ImproperlyConfigured(
+                'settings.MULTISITE_RESOLVER is not callable: %s' %
+                resolver_class
+            )
+    kwargs = getattr(settings, 'MULTISITE_RESOLVER_KWARGS', {})
+    return resolver_class(**kwargs)
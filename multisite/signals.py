@@ -0,0 +1,22 @@
+# -*- coding: utf-8 -*-
+from __future__ import unicode_literals
+from __future__ import absolute_import
+
+from django.dispatch import Signal
+
+
+# Sent by DynamicSiteMiddleware after looking up the Alias of a host.
+# ``source`` is 'cache', 'stale' (a cached Alias past its soft timeout),
+# 'development' or the ``source`` of the configured resolver, like
+# 'database', and ``alias`` is None if nothing matched. ``duration`` is the
+# time the lookup took, in milliseconds.
+alias_resolved = Signal(providing_args=['netloc', 'alias', 'source',
+                                        'duration'])
+
+# Sent by DynamicSiteMiddleware before running the fallback view.
+# ``reason`` is 'disallowed_host' or 'unknown_host'.
+fallback_invoked = Signal(providing_args=['request', 'netloc', 'reason'])
+
+# Sent by DynamicSiteMiddleware when it redirects a request to the
+# canonical domain of its Site.
+canonical_redirect = Signal(providing_args=['request', 'alias'])
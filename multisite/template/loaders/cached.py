@@ -0,0 +1,137 @@
+# -*- coding: utf-8 -*-
+from __future__ import unicode_literals
+from __future__ import absolute_import
+
+import threading
+from collections import OrderedDict
+
+from django.conf import settings
+from django.contrib.sites.models import Site
+from django.template import TemplateDoesNotExist, engines
+from django.template.loaders.cached import Loader as CachedLoader
+
+
+class SiteTemplateCache(object):
+    """
+    Mapping of ``(domain, key)`` pairs to templates.
+
+    At most ``max_entries`` templates are kept for each domain; the least
+    recently used ones are evicted first.
+    """
+
+    def __init__(self, max_entries=None):
+        self.max_entries = max_entries
+        self._sites = {}
+        self._lock = threading.Lock()
+
+    def get(self, key, default=None):
+        domain, name = key
+        with self._lock:
+            site = self._sites.get(domain)
+            if site is None or name not in site:
+                return default
+            # Mark as most recently used
+            value = site[name] = site.pop(name)
+            return value
+
+    def __getitem__(self, key):
+        value = self.get(key, self)
+        if value is self:
+            raise KeyError(key)
+        return value
+
+    def __setitem__(self, key, value):
+        domain, name = key
+        with self._lock:
+            site = self._sites.setdefault(domain, OrderedDict())
+            site.pop(name, None)
+            site[name] = value
+            if self.max_entries is not None:
+                while len(site) > self.max_entries:
+                    site.popitem(last=False)
+
+    def __contains__(self, key):
+        domain, name = key
+        return name in self._sites.get(domain, ())
+
+    def __len__(self):
+        return sum(len(site) for site in self._sites.values())
+
+    def domains(self):
+        """Returns the domains that have cached templates."""
+        return list(self._sites)
+
+    def clear(self, domain=None):
+        """Empties the cache, or only the part of it for ``domain``."""
+        with self._lock:
+            if domain is None:
+                self._sites.clear()
+            else:
+                self._sites.pop(domain, None)
+
+
+class Loader(CachedLoader):
+    """
+    Like django.template.loaders.cached.Loader, but compiled templates are
+    cached per domain of the current Site, so that it can wrap
+    multisite.template.loaders.filesystem.Loader.
+
+    ``settings.MULTISITE_CACHED_TEMPLATES_PER_SITE`` bounds the number of
+    templates kept for each Site.
+    """
+
+    def __init__(self, *args, **kwargs):
+        super(Loader, self).__init__(*args, **kwargs)
+        max_entries = getattr(settings, 'MULTISITE_CACHED_TEMPLATES_PER_SITE',
+                              None)
+        self.template_cache = SiteTemplateCache(max_entries)
+        self.get_template_cache = SiteTemplateCache(max_entries)
+        if hasattr(self, 'find_template_cache'):
+            # Django < 2.0
+            self.find_template_cache = SiteTemplateCache(max_entries)
+
+    def get_domain(self):
+        """Returns the domain of the current Site."""
+        return Site.objects.get_current().domain
+
+    def cache_key(self, *args, **kwargs):
+        key = super(Loader, self).cache_key(*args, **kwargs)
+        return (self.get_domain(), key)
+
+    def warm(self, template_names, sites=None):
+        """
+        Loads ``template_names`` into the cache for each of ``sites``.
+
+        ``sites`` defaults to all Site objects. Missing templates are
+        skipped.
+        """
+        if sites is None:
+            sites = Site.objects.all()
+        for site in sites:
+            with settings.SITE_ID.override(site.pk):
+                for template_name in template_names:
+                    try:
+                        if hasattr(self, 'get_template'):
+                            self.get_template(template_name)
+                        else:
+                            # Django < 1.9
+                            self.load_template(template_name)
+                    except TemplateDoesNotExist:
+                        pass
+
+
+def warm_template_cache(template_names, sites=None):
+    """
+    Loads ``template_names`` for ``sites`` into every multisite cached
+    Loader of the configured Django template engines.
+
+    Call this once at startup, e.g. from the WSGI module, so that the first
+    requests of each Site don't have to compile them.
+    """
+    if sites is not None:
+        sites = list(sites)
+    for engine in engines.all():
+        engine = getattr(engine, 'engine', None)
+        for loader in getattr(engine, 'template_loaders', ()):
+            if isinstance(loader, Loader):
+                loader.warm(template_names, sites=sites)
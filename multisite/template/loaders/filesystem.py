@@ -5,21 +5,157 @@ from __future__ import absolute_import
 import os
 from django.conf import settings
 from django.contrib.sites.models import Site
+from django.core.exceptions import ImproperlyConfigured
 from django.template.loaders.filesystem import Loader as FilesystemLoader
 from django import VERSION as django_version
 
 
+SOURCE_CACHE_MODES = (None, 'static', 'mtime', 'index')
+
+
+def _origin_name(origin):
+    # Django < 1.9 yields plain paths instead of Origin objects
+    return getattr(origin, 'name', origin)
+
+
+def _mtime(path):
+    try:
+        return os.stat(path).st_mtime
+    except OSError:
+        return None
+
+
 class Loader(FilesystemLoader):
-    def get_template_sources(self, *args, **kwargs):
-        template_name = args[0]
-        domain = Site.objects.get_current().domain
+    """
+    Looks up ``<domain>/<template_name>`` and then
+    ``<MULTISITE_DEFAULT_TEMPLATE_DIR>/<template_name>`` in each template
+    directory.
+
+    When ``settings.MULTISITE_TEMPLATE_SOURCE_CACHE`` is set, the template
+    sources that exist on disk are remembered per (domain, template_name),
+    so candidates that are missing are not probed again on every lookup:
+
+    - ``'static'`` keeps the resolution until ``reset()`` is called.
+    - ``'mtime'`` revalidates an entry whenever the modification time of
+      one of the directories holding its candidates changes.
+    - ``'index'`` scans ``<domain>/`` and the default directory once per
+      domain, and only yields the templates found there. Sites without
+      overrides go straight to the default directory. The index is kept
+      until ``reset()`` is called.
+    """
+
+    def __init__(self, *args, **kwargs):
+        super(Loader, self).__init__(*args, **kwargs)
+        self.source_cache_mode = getattr(
+            settings, 'MULTISITE_TEMPLATE_SOURCE_CACHE', None
+        )
+        if self.source_cache_mode not in SOURCE_CACHE_MODES:
+            raise ImproperlyConfigured(
+                'Invalid MULTISITE_TEMPLATE_SOURCE_CACHE: %r' %
+                self.source_cache_mode
+            )
+        self.source_cache = {}
+        self.directory_index = {}
+
+    def get_domain(self):
+        """Returns the domain of the current Site."""
+        return Site.objects.get_current().domain
+
+    def get_site_template_dirs(self, domain):
+        """Returns the subdirectories to look up for ``domain``, in order."""
         default_dir = getattr(settings, 'MULTISITE_DEFAULT_TEMPLATE_DIR',
                                         'default')
-        for tname in (os.path.join(domain, template_name),
-                      os.path.join(default_dir, template_name)):
-            if django_version < (2, 0, 0):
-                args = [tname, None]
-            else:
-                args = [tname]
-            for item in super(Loader, self).get_template_sources(*args, **kwargs):
+        return (domain, default_dir)
+
+    def _get_sources(self, tname, **kwargs):
+        if django_version < (2, 0, 0):
+            args = [tname, None]
+        else:
+            args = [tname]
+        return super(Loader, self).get_template_sources(*args, **kwargs)
+
+    def get_candidate_sources(self, domain, template_name, **kwargs):
+        for dirname in self.get_site_template_dirs(domain):
+            tname = os.path.join(dirname, template_name)
+            for item in self._get_sources(tname, **kwargs):
                 yield item
+
+    def get_indexed_sources(self, domain, template_name, **kwargs):
+        """
+        Returns the template sources for ``template_name`` on ``domain``
+        that are present in the directory index.
+        """
+        for dirname in self.get_site_template_dirs(domain):
+            index = self.get_directory_index(dirname)
+            if not index:
+                continue
+            tname = os.path.join(dirname, template_name)
+            for item in self._get_sources(tname, **kwargs):
+                if _origin_name(item) in index:
+                    yield item
+
+    def get_directory_index(self, dirname):
+        """
+        Returns the absolute paths of all files in ``dirname`` within the
+        template directories, scanning them on first use.
+        """
+        index = self.directory_index.get(dirname)
+        if index is None:
+            paths = set()
+            for template_dir in self._get_dirs():
+                root = os.path.abspath(os.path.join(template_dir, dirname))
+                for dirpath, _, filenames in os.walk(root, followlinks=True):
+                    paths.update(os.path.join(dirpath, filename)
+                                 for filename in filenames)
+            index = self.directory_index[dirname] = frozenset(paths)
+        return index
+
+    def _get_dirs(self):
+        if hasattr(self, 'get_dirs'):
+            return self.get_dirs()
+        return self.engine.dirs    # Django < 1.9
+
+    def get_template_sources(self, *args, **kwargs):
+        template_name = args[0]
+        domain = self.get_domain()
+        if self.source_cache_mode is None:
+            sources = self.get_candidate_sources(domain, template_name,
+                                                 **kwargs)
+        elif self.source_cache_mode == 'index':
+            sources = self.get_indexed_sources(domain, template_name,
+                                               **kwargs)
+        else:
+            sources = self.get_cached_sources(domain, template_name, **kwargs)
+        for item in sources:
+            yield item
+
+    def get_cached_sources(self, domain, template_name, **kwargs):
+        """
+        Returns the template sources for ``template_name`` on ``domain`` that
+        exist on disk, using the resolution cache.
+        """
+        key = (domain, template_name)
+        entry = self.source_cache.get(key)
+        if entry is None or not self._source_cache_entry_valid(entry):
+            candidates = list(
+                self.get_candidate_sources(domain, template_name, **kwargs)
+            )
+            sources = tuple(c for c in candidates
+                            if os.path.isfile(_origin_name(c)))
+            if self.source_cache_mode == 'mtime':
+                dirnames = tuple(os.path.dirname(_origin_name(c))
+                                 for c in candidates)
+                mtimes = tuple(_mtime(d) for d in dirnames)
+            else:
+                dirnames = mtimes = ()
+            entry = self.source_cache[key] = (sources, dirnames, mtimes)
+        return entry[0]
+
+    def _source_cache_entry_valid(self, entry):
+        sources, dirnames, mtimes = entry
+        return tuple(_mtime(d) for d in dirnames) == mtimes
+
+    def reset(self):
+        super(Loader, self).reset()
+        self.source_cache.clear()
+        self.directory_index.clear()
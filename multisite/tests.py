@@ -17,10 +17,12 @@ import django
 import logging
 import os
 import pytest
+import shutil
 import sys
 import tempfile
+import time
 import warnings
-from unittest import skipUnless
+from unittest import skipIf, skipUnless
 
 try:
     from unittest import mock
@@ -29,21 +31,48 @@ except ImportError:
 
 from django.conf import settings
 from django.conf.urls import url
+from django.contrib.admin import AdminSite
+from django.contrib.auth.models import Permission, User
 from django.contrib.sites.models import Site
-from django.core.exceptions import ImproperlyConfigured, ValidationError
+from django.core.cache import caches
+from django.core.cache.backends.base import DEFAULT_TIMEOUT
+from django.core.exceptions import (ImproperlyConfigured, PermissionDenied,
+                                    ValidationError)
 from django.core.management import call_command
+from django.db import IntegrityError, connection
+from django.forms.models import modelform_factory
 from django.http import Http404, HttpResponse
+from django.template import Context, TemplateDoesNotExist, engines
 from django.template.loader import get_template
-from django.test import TestCase, override_settings
+from django.test import TestCase, TransactionTestCase, override_settings
 from django.test.client import RequestFactory as DjangoRequestFactory
+from django.test.utils import CaptureQueriesContext
 from django.utils.six import StringIO
 
-from multisite import SiteDomain, SiteID, threadlocals
+from multisite import SiteDomain, SiteID, benchmarks, threadlocals
 
-from .hacks import use_framework_for_site_cache
+from .admin import (MultisiteModelAdmin, SiteListFilter,
+                    SiteScopedAutocompleteSelect, get_user_site_choices)
+from .cache import TwoTierCache, _LocalStore
+from .forms import SiteForm
+from .hacks import get_sites_by_id, use_framework_for_site_cache
 from .hosts import ALLOWED_HOSTS, AllowedHosts, IterableLazyObject
+from .managers import SpanningCurrentSiteManager
+from .metrics import (MemorySink, SiteMetricsMiddleware, StatsdSink,
+                      get_sink)
 from .middleware import CookieDomainMiddleware, DynamicSiteMiddleware
 from .models import Alias
+from .resolvers import (CacheResolver, DatabaseResolver,
+                        SnapshotFileResolver, SnapshotResolver,
+                        StaticResolver, dump_snapshot)
+from .signals import alias_resolved
+
+try:
+    from django.test.utils import isolate_apps
+except ImportError:
+    # Django < 1.10, where the tests that need it are skipped
+    def isolate_apps(*app_labels, **kwargs):
+        return lambda func: func
 
 
 class RequestFactory(DjangoRequestFactory):
@@ -281,6 +310,214 @@ class DynamicSiteMiddlewareSettingsTest(TestCase):
         self.assertRaises(TypeError, DynamicSiteMiddleware)
 
 
+@pytest.mark.django_db
+@override_settings(
+    SITE_ID=SiteID(default=0),
+    CACHE_MULTISITE_ALIAS='multisite',
+    CACHES={
+        'multisite': {'BACKEND': 'django.core.cache.backends.dummy.DummyCache'},
+        'resolver': {'BACKEND': 'django.core.cache.backends.locmem.LocMemCache'}
+    },
+    MULTISITE_FALLBACK=None,
+    ALLOWED_HOSTS=['*']
+)
+class ResolverTest(TestCase):
+    def setUp(self):
+        self.factory = RequestFactory(host='example.com')
+
+        Site.objects.all().delete()
+        self.site = Site.objects.create(domain='example.com')
+        self.site2 = Site.objects.create(domain='example.org')
+        Alias.objects.create(site=self.site2, domain='*.example.org')
+
+    def assertResolves(self, resolver, host, site, port=None):
+        alias = resolver.resolve(host=host, port=port)
+        self.assertEqual(alias.site_id, site.pk)
+        self.assertEqual(alias.site.domain, site.domain)
+
+    def test_default(self):
+        middleware = DynamicSiteMiddleware()
+        self.assertIsInstance(middleware.resolver, DatabaseResolver)
+        self.assertResolves(middleware.resolver, 'www.example.org',
+                            self.site2)
+
+    def test_setting(self):
+        with override_settings(
+            MULTISITE_RESOLVER='multisite.resolvers.SnapshotResolver',
+            MULTISITE_RESOLVER_KWARGS={'timeout': None},
+        ):
+            resolver = DynamicSiteMiddleware().resolver
+        self.assertIsInstance(resolver, SnapshotResolver)
+        self.assertIsNone(resolver.timeout)
+
+        with override_settings(MULTISITE_RESOLVER='multisite.Invalid'):
+            self.assertRaises(ImproperlyConfigured, DynamicSiteMiddleware)
+
+    def test_snapshot(self):
+        resolver = SnapshotResolver()
+        self.assertResolves(resolver, 'example.com', self.site)
+        with self.assertNumQueries(0):
+            self.assertResolves(resolver, 'WWW.example.org', self.site2, 80)
+            self.assertIsNone(resolver.resolve('example.net'))
+        # Saving an Alias reloads the snapshot
+        Alias.objects.create(site=self.site, domain='example.net')
+        with self.assertNumQueries(1):
+            self.assertResolves(resolver, 'example.net', self.site)
+        # So does the timeout
+        resolver._expires = 0
+        with self.assertNumQueries(1):
+            self.assertResolves(resolver, 'example.net', self.site)
+
+    def test_cache_only(self):
+        resolver = CacheResolver(cache='resolver')
+        resolver.cache.clear()
+        self.assertIsNone(resolver.resolve('example.com'))
+        self.assertEqual(resolver.populate(), 3)
+        with self.assertNumQueries(0):
+            self.assertResolves(resolver, 'example.com', self.site, 8000)
+            self.assertResolves(resolver, 'www.example.org', self.site2)
+        # Aliases are stored when saved, and removed when deleted
+        alias = Alias.objects.create(site=self.site, domain='example.net')
+        with self.assertNumQueries(0):
+            self.assertResolves(resolver, 'example.net', self.site)
+        # Renamed Aliases are removed under their previous domain
+        alias.domain = 'example.info'
+        alias.save()
+        self.assertIsNone(resolver.resolve('example.net'))
+        self.assertResolves(resolver, 'example.info', self.site)
+        alias.delete()
+        self.assertIsNone(resolver.resolve('example.info'))
+        # So are canonical Aliases, when their Site's domain changes
+        self.site2.domain = 'example.biz'
+        self.site2.save()
+        self.assertIsNone(resolver.resolve('example.org'))
+        self.assertResolves(resolver, 'example.biz', self.site2)
+        self.site2.domain = 'example.org'
+        self.site2.save()
+        # Aliases are stored again with their Site
+        self.site.name = 'Renamed'
+        self.site.save()
+        self.assertEqual(resolver.resolve('example.com').site.name,
+                         'Renamed')
+
+    def test_cache_only_requires_separate_cache(self):
+        self.assertRaises(ImproperlyConfigured, CacheResolver)
+        with override_settings(CACHE_MULTISITE_ALIAS='resolver'):
+            self.assertRaises(ImproperlyConfigured, CacheResolver,
+                              cache='resolver')
+
+    def test_static(self):
+        fd, path = tempfile.mkstemp(suffix='.json')
+        self.addCleanup(os.remove, path)
+        with os.fdopen(fd, 'w') as f:
+            f.write('{"example.com": %d, "*.Example.net": '
+                    '{"site": %d, "redirect_to_canonical": true}}' %
+                    (self.site.pk, self.site2.pk))
+
+        self.assertRaises(ImproperlyConfigured, StaticResolver)
+        with override_settings(
+            MULTISITE_RESOLVER=StaticResolver,
+            MULTISITE_RESOLVER_KWARGS={'path': path},
+        ):
+            middleware = DynamicSiteMiddleware()
+        self.assertResolves(middleware.resolver, 'example.com', self.site)
+        # Only the Aliases in the file are known
+        self.assertIsNone(middleware.resolver.resolve('www.example.org'))
+
+        request = self.factory.get('/path', host='www.example.net')
+        response = middleware.process_request(request)
+        self.assertEqual(response.status_code, 301)
+        self.assertEqual(response['Location'], 'http://example.org/path')
+        self.assertEqual(settings.SITE_ID, self.site2.pk)
+
+
+@pytest.mark.django_db
+@override_settings(
+    SITE_ID=SiteID(default=0),
+    CACHE_MULTISITE_ALIAS='multisite',
+    CACHES={
+        'multisite': {'BACKEND': 'django.core.cache.backends.dummy.DummyCache'}
+    },
+    MULTISITE_FALLBACK=None,
+    ALLOWED_HOSTS=['*']
+)
+class SnapshotFileResolverTest(TestCase):
+    def setUp(self):
+        self.factory = RequestFactory(host='example.com')
+
+        Site.objects.all().delete()
+        self.site = Site.objects.create(domain='example.com',
+                                        name='Example\tsite')
+        self.site2 = Site.objects.create(domain='example.org')
+        Alias.objects.create(site=self.site2, domain='*.Example.org')
+        Alias.objects.create(site=self.site2, domain='example.org:8000',
+                             redirect_to_canonical=False)
+
+        self.tempdir = tempfile.mkdtemp()
+        self.addCleanup(shutil.rmtree, self.tempdir)
+        self.path = os.path.join(self.tempdir, 'aliases.snapshot')
+        out = StringIO()
+        call_command('dump_alias_snapshot', self.path, stdout=out)
+        self.assertEqual(out.getvalue().strip(),
+                         '4 aliases written to %s' % self.path)
+
+    def assertResolves(self, resolver):
+        with self.assertNumQueries(0):
+            alias = resolver.resolve('example.com')
+            self.assertEqual(alias.site_id, self.site.pk)
+            self.assertTrue(alias.is_canonical)
+            self.assertEqual(alias.site.name, 'Example\tsite')
+
+            alias = resolver.resolve('www.example.org')
+            self.assertEqual(alias.domain, '*.example.org')
+            self.assertIsNone(alias.is_canonical)
+            self.assertTrue(alias.redirect_to_canonical)
+            self.assertEqual(alias.site.domain, 'example.org')
+
+            alias = resolver.resolve('example.org', 8000)
+            self.assertEqual(alias.domain, 'example.org:8000')
+            self.assertFalse(alias.redirect_to_canonical)
+
+            self.assertIsNone(resolver.resolve('example.net'))
+
+    def test_resolve(self):
+        self.assertResolves(SnapshotFileResolver(path=self.path))
+
+    def test_mmap(self):
+        self.assertResolves(SnapshotFileResolver(path=self.path,
+                                                 use_mmap=True))
+
+    def test_reload(self):
+        resolver = SnapshotFileResolver(path=self.path, check_interval=60)
+        Alias.objects.create(site=self.site, domain='example.net')
+        dump_snapshot(self.path)
+        self.assertIsNone(resolver.resolve('example.net'))
+        # The new file is loaded at the next check
+        resolver.check_interval = 0
+        self.assertEqual(resolver.resolve('example.net').site_id,
+                         self.site.pk)
+        # An invalid file is ignored
+        with open(self.path, 'w') as f:
+            f.write('invalid')
+        self.assertEqual(resolver.resolve('example.net').site_id,
+                         self.site.pk)
+        self.assertRaises(ValueError, SnapshotFileResolver, path=self.path)
+
+    def test_middleware(self):
+        with override_settings(
+            MULTISITE_RESOLVER='multisite.resolvers.SnapshotFileResolver',
+            MULTISITE_RESOLVER_KWARGS={'path': self.path, 'use_mmap': True},
+        ):
+            middleware = DynamicSiteMiddleware()
+        with self.assertNumQueries(0):
+            request = self.factory.get('/path', host='www.example.org')
+            response = middleware.process_request(request)
+            self.assertEqual(response['Location'], 'http://example.org/path')
+            request = self.factory.get('/path', host='example.org:8000')
+            self.assertIsNone(middleware.process_request(request))
+        self.assertEqual(settings.SITE_ID, self.site2.pk)
+
+
 @pytest.mark.django_db
 @override_settings(
     SITE_ID=SiteID(default=0),
@@ -299,6 +536,46 @@ class CacheTest(TestCase):
         Site.objects.all().delete()
         self.site = Site.objects.create(domain=self.host)
 
+    def test_current_site_memoized(self):
+        from django.contrib.sites import models
+        middleware = DynamicSiteMiddleware()
+        middleware.cache.clear()
+        # The Site of the Alias, when it is resolved
+        request = self.factory.get('/')
+        middleware.process_request(request)
+        self.assertEqual(request.site, self.site)
+        with mock.patch.object(models.SITE_CACHE, 'get') as get:
+            self.assertIs(Site.objects.get_current(), request.site)
+            get.assert_not_called()
+        # The first Site returned by get_current(), when the Alias is cached
+        request = self.factory.get('/')
+        middleware.process_request(request)
+        self.assertIsNone(settings.SITE_ID.site)
+        with mock.patch.object(models.SITE_CACHE, 'get',
+                               wraps=models.SITE_CACHE.get) as get:
+            site = Site.objects.get_current()
+            self.assertIs(Site.objects.get_current(), site)
+            self.assertEqual(request.site, site)
+            self.assertEqual(get.call_count, 1)
+        # Until the Site changes
+        self.site.name = 'Renamed'
+        self.site.save()
+        self.assertEqual(Site.objects.get_current().name, 'Renamed')
+        # Or SITE_ID does
+        with settings.SITE_ID.override(self.site.pk):
+            self.assertIsNone(settings.SITE_ID.site)
+
+    def test_request_site_bound_to_alias(self):
+        other = Site.objects.create(domain='other.example.com')
+        middleware = DynamicSiteMiddleware()
+        middleware.cache.clear()
+        middleware.process_request(self.factory.get('/'))
+        # The Alias is cached, and request.site is evaluated lazily
+        request = self.factory.get('/')
+        middleware.process_request(request)
+        with settings.SITE_ID.override(other.pk):
+            self.assertEqual(request.site, self.site)
+
     def test_site_domain_changed(self):
         # Test to ensure that the cache is cleared properly
         middleware = DynamicSiteMiddleware()
@@ -320,6 +597,373 @@ class CacheTest(TestCase):
         self.assertEqual(settings.SITE_ID, 0)
 
 
+@pytest.mark.django_db
+@override_settings(
+    SITE_ID=SiteID(default=0),
+    CACHE_MULTISITE_ALIAS='multisite',
+    CACHE_MULTISITE_SOFT_TIMEOUT=60,
+    CACHES={
+        'multisite': {'BACKEND': 'django.core.cache.backends.locmem.LocMemCache'}
+    },
+    MULTISITE_FALLBACK=None,
+    ALLOWED_HOSTS=['*']
+)
+class StaleWhileRevalidateTest(TestCase):
+    def setUp(self):
+        self.host = 'example.com'
+        self.factory = RequestFactory(host=self.host)
+
+        Site.objects.all().delete()
+        self.site = Site.objects.create(domain=self.host)
+        self.site2 = Site.objects.create(domain='example.org')
+
+        self.middleware = DynamicSiteMiddleware()
+        self.middleware.cache.clear()
+        self.cache_key = self.middleware.get_cache_key(self.host)
+        # A stale entry, from before the host moved to self.site
+        self.middleware.cache.set(
+            self.cache_key, (Alias.canonical.get(site=self.site2), 0)
+        )
+
+    def test_fresh(self):
+        self.middleware.cache.clear()
+        request = self.factory.get('/')
+        self.assertIsNone(self.middleware.process_request(request))
+        alias, stale = self.middleware.get_cached_alias(self.cache_key)
+        self.assertEqual(alias.site_id, self.site.pk)
+        self.assertFalse(stale)
+        with self.assertNumQueries(0):
+            self.middleware.process_request(request)
+        self.assertEqual(settings.SITE_ID, self.site.pk)
+
+    def test_lease(self):
+        request = self.factory.get('/')
+        # Served stale, then refreshed by the request
+        self.assertIsNone(self.middleware.process_request(request))
+        self.assertEqual(settings.SITE_ID, self.site2.pk)
+        alias, stale = self.middleware.get_cached_alias(self.cache_key)
+        self.assertEqual(alias.site_id, self.site.pk)
+        self.assertFalse(stale)
+
+        self.middleware.process_request(request)
+        self.assertEqual(settings.SITE_ID, self.site.pk)
+
+    def test_lease_taken(self):
+        self.middleware.cache.add(self.cache_key + '.lease', True)
+        request = self.factory.get('/')
+        with self.assertNumQueries(0):
+            self.middleware.process_request(request)
+        self.assertEqual(settings.SITE_ID, self.site2.pk)
+        self.assertTrue(self.middleware.get_cached_alias(self.cache_key)[1])
+
+    def test_refresh_error(self):
+        request = self.factory.get('/')
+        with mock.patch.object(self.middleware.resolver, 'resolve',
+                               side_effect=Exception), \
+                mock.patch('multisite.middleware.logger') as logger:
+            self.middleware.process_request(request)
+        self.assertEqual(logger.exception.call_count, 1)
+        self.assertEqual(settings.SITE_ID, self.site2.pk)
+        self.assertTrue(self.middleware.get_cached_alias(self.cache_key)[1])
+        # The lease keeps other requests from retrying for a while
+        with self.assertNumQueries(0):
+            self.middleware.process_request(request)
+
+    def test_removed(self):
+        Alias.objects.filter(site=self.site).delete()
+        request = self.factory.get('/')
+        self.middleware.process_request(request)
+        self.assertEqual(settings.SITE_ID, self.site2.pk)
+        self.assertIsNone(self.middleware.cache.get(self.cache_key))
+        self.assertRaises(Http404, self.middleware.process_request, request)
+
+    def test_thread(self):
+        with override_settings(CACHE_MULTISITE_REFRESH='thread'):
+            middleware = DynamicSiteMiddleware()
+        request = self.factory.get('/')
+        with mock.patch('multisite.middleware.threading.Thread') as thread:
+            middleware.process_request(request)
+        thread.assert_called_once_with(
+            target=middleware._refresh_in_thread,
+            args=('example.com', self.cache_key)
+        )
+        thread.return_value.start.assert_called_once_with()
+        self.assertEqual(settings.SITE_ID, self.site2.pk)
+        self.assertTrue(middleware.get_cached_alias(self.cache_key)[1])
+
+        with override_settings(CACHE_MULTISITE_REFRESH='invalid'):
+            self.assertRaises(ImproperlyConfigured, DynamicSiteMiddleware)
+
+
+@pytest.mark.django_db
+@override_settings(
+    SITE_ID=SiteID(default=0),
+    CACHE_MULTISITE_ALIAS='multisite',
+    CACHES={
+        'shared': {'BACKEND': 'django.core.cache.backends.locmem.LocMemCache',
+                   'LOCATION': 'shared'},
+        'multisite': {'BACKEND': 'multisite.cache.TwoTierCache',
+                      'LOCATION': 'shared',
+                      'OPTIONS': {'MAX_ENTRIES': 3}},
+    },
+    MULTISITE_FALLBACK=None,
+    ALLOWED_HOSTS=['*']
+)
+class TwoTierCacheTest(TestCase):
+    def setUp(self):
+        self.cache = caches['multisite']
+        self.shared = caches['shared']
+        self.cache.clear()
+
+    def other_process(self):
+        cache = TwoTierCache('shared', {})
+        cache._store = _LocalStore()
+        return cache
+
+    def test_local(self):
+        self.cache.set('key', 'value')
+        self.assertEqual(self.shared.get('key'), 'value')
+        # Changes to the shared cache are seen after the local timeout
+        self.shared.set('key', 'changed')
+        self.assertEqual(self.cache.get('key'), 'value')
+        with mock.patch('multisite.cache.time.time',
+                        return_value=time.time() + 5):
+            self.assertEqual(self.cache.get('key'), 'changed')
+
+    def test_get(self):
+        self.shared.set_many({'a': 1, 'b': 2})
+        other = self.other_process()
+        with mock.patch.object(self.shared, 'get',
+                               wraps=self.shared.get) as get:
+            self.assertEqual(other.get('a'), 1)
+            self.assertEqual(other.get('a'), 1)
+            self.assertIsNone(other.get('missing'))
+            self.assertEqual(get.call_count, 3)
+        self.assertEqual(other.get_many(['a', 'b', 'missing']),
+                         {'a': 1, 'b': 2})
+        with mock.patch.object(self.shared, 'get_many') as get_many:
+            self.assertEqual(other.get_many(['a', 'b']), {'a': 1, 'b': 2})
+            get_many.assert_not_called()
+
+    def test_set_unchanged(self):
+        self.cache.set('key', 'value')
+        with mock.patch.object(self.shared, 'set') as set_:
+            self.cache.set('key', 'value')
+            set_.assert_not_called()
+            self.cache.set('key', 'changed')
+            set_.assert_called_once_with('key', 'changed',
+                                         timeout=DEFAULT_TIMEOUT,
+                                         version=None)
+
+    def test_set_read_value(self):
+        # Values read from the shared cache are written again
+        self.shared.set('key', 'value')
+        self.assertEqual(self.cache.get('key'), 'value')
+        with mock.patch.object(self.shared, 'set') as set_:
+            self.cache.set('key', 'value')
+            set_.assert_called_once_with('key', 'value',
+                                         timeout=DEFAULT_TIMEOUT,
+                                         version=None)
+
+    def test_set_deleted_value(self):
+        other = self.other_process()
+        self.cache.set('key', 'value')
+        other.delete('key')
+        self.cache._store.checked = 0
+        self.cache.set('key', 'value')
+        self.assertEqual(self.shared.get('key'), 'value')
+
+    def test_lru(self):
+        for key in 'abcd':
+            self.cache.set(key, key)
+        self.assertEqual(list(self.cache._store.entries),
+                         [self.shared.make_key(key) for key in 'bcd'])
+
+    def test_invalidation(self):
+        other = self.other_process()
+        self.cache.set('key', 'value')
+        self.assertEqual(other.get('key'), 'value')
+        self.cache.set('key', 'changed')
+        self.cache.delete('unrelated')
+        # Other processes check the generation every CHECK_INTERVAL
+        self.assertEqual(other.get('key'), 'value')
+        other._store.checked = 0
+        self.assertEqual(other.get('key'), 'changed')
+
+    def test_middleware(self):
+        Site.objects.all().delete()
+        site = Site.objects.create(domain='example.com')
+        middleware = DynamicSiteMiddleware()
+        request = RequestFactory(host='example.com').get('/')
+        middleware.process_request(request)
+        with mock.patch.object(self.shared, 'get') as get, \
+                mock.patch.object(self.shared, 'set') as set_:
+            middleware.process_request(request)
+            get.assert_not_called()
+            set_.assert_not_called()
+        self.assertEqual(settings.SITE_ID, site.pk)
+
+
+@pytest.mark.django_db
+@override_settings(
+    SITE_ID=SiteID(default=0),
+    CACHE_MULTISITE_ALIAS='multisite',
+    CACHES={
+        'multisite': {'BACKEND': 'django.core.cache.backends.locmem.LocMemCache'}
+    },
+    MULTISITE_FALLBACK=None,
+    MULTISITE_METRICS_SINK='multisite.metrics.MemorySink',
+    ALLOWED_HOSTS=ALLOWED_HOSTS
+)
+class SiteMetricsTest(TestCase):
+    def setUp(self):
+        self.factory = RequestFactory(host='example.com')
+        Site.objects.all().delete()
+        self.site = Site.objects.create(domain='example.com')
+        self.sink = get_sink()
+        self.sink.clear()
+        self.middleware = DynamicSiteMiddleware()
+        self.middleware.cache.clear()
+
+    def get(self, host='example.com'):
+        metrics = SiteMetricsMiddleware()
+        request = self.factory.get('/', host=host)
+        metrics.process_request(request)
+        try:
+            response = self.middleware.process_request(request)
+        except Http404:
+            response = HttpResponse(status=404)
+        Site.objects.count()
+        return metrics.process_response(request, response or HttpResponse())
+
+    def test_site_metrics(self):
+        self.assertIsInstance(self.sink, MemorySink)
+        self.get()
+        self.get()
+        name = 'multisite.site.%s.%%s' % self.site.pk
+        self.assertEqual(self.sink.counters[name % 'requests'], 2)
+        self.assertEqual(self.sink.counters[name % 'alias_cache.miss'], 1)
+        self.assertEqual(self.sink.counters[name % 'alias_cache.hit'], 1)
+        self.assertEqual(len(self.sink.timings[name % 'request_time']), 2)
+
+    @skipUnless(hasattr(connection, 'execute_wrapper'),
+                'Counting queries requires Django 2.0')
+    def test_query_metrics(self):
+        self.get()
+        self.get()
+        name = 'multisite.site.%s.%%s' % self.site.pk
+        # ALLOWED_HOSTS and Site.objects.count() on each request, and
+        # resolving the Alias once
+        self.assertEqual(self.sink.counters[name % 'db.queries'], 5)
+        self.assertEqual(len(self.sink.timings[name % 'db.time']), 2)
+
+    def test_unknown_site(self):
+        self.get(host='unknown.example.com')
+        self.assertEqual(
+            self.sink.counters['multisite.site.unknown.requests'], 1
+        )
+
+    def test_disabled(self):
+        with override_settings(MULTISITE_METRICS_SINK=None):
+            self.assertIsNone(get_sink())
+            self.get()
+        self.assertEqual(dict(self.sink.counters), {})
+
+    def test_resolution_metrics(self):
+        Alias.objects.create(site=self.site, domain='www.example.com')
+        self.get()
+        self.get()
+        self.get(host='www.example.com')
+        self.get(host='unknown.example.com')
+        with override_settings(ALLOWED_HOSTS=['*']):
+            self.get(host='unknown.example.com')
+        counters = self.sink.counters
+        self.assertEqual(counters['multisite.alias.cache'], 1)
+        self.assertEqual(counters['multisite.alias.database'], 2)
+        self.assertEqual(counters['multisite.alias.not_found'], 1)
+        self.assertEqual(counters['multisite.fallback.disallowed_host'], 1)
+        self.assertEqual(counters['multisite.fallback.unknown_host'], 1)
+        self.assertEqual(counters['multisite.redirect'], 1)
+        self.assertEqual(
+            len(self.sink.timings['multisite.alias.database.time']), 2
+        )
+
+    def test_resolution_signals(self):
+        received = []
+
+        def handler(signal, sender, **kwargs):
+            received.append((kwargs['netloc'], kwargs['alias'],
+                             kwargs['source']))
+
+        alias_resolved.connect(handler)
+        try:
+            self.get()
+            self.get()
+        finally:
+            alias_resolved.disconnect(handler)
+        alias = Alias.canonical.get(site=self.site)
+        self.assertEqual(received, [('example.com', alias, 'database'),
+                                    ('example.com', alias, 'cache')])
+
+    def test_statsd_sink(self):
+        sink = StatsdSink(prefix='app.')
+        with mock.patch.object(sink, 'socket') as sock:
+            sink.incr('multisite.site.1.requests')
+            sink.timing('multisite.site.1.request_time', 1.5)
+        self.assertEqual(sock.sendto.mock_calls, [
+            mock.call(b'app.multisite.site.1.requests:1|c',
+                      ('localhost', 8125)),
+            mock.call(b'app.multisite.site.1.request_time:1.500|ms',
+                      ('localhost', 8125)),
+        ])
+
+
+@pytest.mark.django_db
+class BenchmarkTest(TestCase):
+    def test_run(self):
+        benchmarks.seed(sites=3, aliases=3)
+        self.assertEqual(Alias.objects.filter(site__name='2').count(), 4)
+        results = benchmarks.run(number=1, repeat=1)
+        self.assertEqual(sorted(results), [
+            'expand_netloc',
+            'process_request.cache_hit',
+            'process_request.cache_miss',
+            'process_request.redirect',
+            'process_request.unknown_host',
+            'resolve.port',
+            'resolve.wildcard',
+        ])
+        self.assertTrue(all(r['best'] > 0 for r in results.values()))
+
+    def test_provisioning_budgets(self):
+        if not Alias._has_domain_index(connection.alias):
+            self.skipTest('The domain index has not been migrated')
+        for sites in (3, 10):
+            results = benchmarks.provision(sites)
+            self.assertEqual(sorted(results),
+                             sorted(benchmarks.QUERY_BUDGETS))
+            self.assertEqual(benchmarks.over_budget(results), [])
+        self.assertEqual(Alias.canonical.count(), 10)
+
+    def test_admin_budgets(self):
+        benchmarks.seed(sites=10, aliases=6)
+        results = benchmarks.run_admin(repeat=2)
+        self.assertEqual(sorted(results),
+                         sorted(benchmarks.ADMIN_QUERY_BUDGETS))
+        self.assertEqual(benchmarks.admin_over_budget(results), [])
+
+    def test_over_budget(self):
+        results = {'sync.unchanged': {'sites': 10, 'queries': 11,
+                                      'transaction_statements': 0}}
+        self.assertEqual(benchmarks.over_budget(results), ['sync.unchanged'])
+        # An extra savepoint per Site
+        results = {'sync.unchanged': {'sites': 10, 'queries': 10,
+                                      'transaction_statements': 20}}
+        self.assertEqual(benchmarks.over_budget(results), ['sync.unchanged'])
+        results['sync.unchanged']['transaction_statements'] = 0
+        self.assertEqual(benchmarks.over_budget(results), [])
+
+
 @pytest.mark.django_db
 @skipUnless(Site._meta.installed,
             'django.contrib.sites is not in settings.INSTALLED_APPS')
@@ -388,6 +1032,32 @@ class SiteCacheTest(TestCase):
         self.assertEqual(Site.objects.get_current(), self.site)
         self.assertEqual(Site.objects.get_current().domain, self.site.domain)
 
+    def test_get_set_many(self):
+        site = Site.objects.create(domain='example.org')
+        self.assertEqual(self.cache.get_many([self.site.id, site.id]), {})
+        self.cache.set_many({self.site.id: self.site, site.id: site})
+        self.assertEqual(self.cache.get_many([self.site.id, site.id, -1]),
+                         {self.site.id: self.site, site.id: site})
+
+    def test_get_sites_by_id(self):
+        site = Site.objects.create(domain='example.org')
+        self.cache.clear()
+        self.cache[self.site.id] = self.site
+        with mock.patch.object(self.cache, 'get_many',
+                               wraps=self.cache.get_many) as get_many, \
+                self.assertNumQueries(1):
+            self.assertEqual(
+                get_sites_by_id([self.site.id, site.id, -1, site.id]),
+                {self.site.id: self.site, site.id: site}
+            )
+            self.assertEqual(get_many.call_count, 1)
+        # The missing Sites are now cached
+        self.assertEqual(self.cache[site.id], site)
+        with self.assertNumQueries(0):
+            self.assertEqual(get_sites_by_id([settings.SITE_ID, site.id]),
+                             {self.site.id: self.site, site.id: site})
+            self.assertEqual(get_sites_by_id([]), {})
+
     def test_delete_site(self):
         self.assertEqual(Site.objects.get_current(), self.site)
         self.assertEqual(Site.objects.get_current().domain, self.site.domain)
@@ -518,6 +1188,20 @@ class TestSiteID(TestCase):
             self.assertEqual(self.site_id.site_id, 1)
         self.assertEqual(self.site_id.site_id, None)
 
+    def test_set_site(self):
+        self.site_id.set_site(self.site)
+        self.assertEqual(self.site_id, self.site.id)
+        self.assertIs(self.site_id.site, self.site)
+        with self.site_id.override(2):
+            self.assertIsNone(self.site_id.site)
+            self.assertFalse(self.site_id.memoize)
+        self.assertIs(self.site_id.site, self.site)
+        self.site_id.set(self.site)
+        self.assertIsNone(self.site_id.site)
+        self.site_id.set_site(self.site)
+        self.site_id.reset()
+        self.assertIsNone(self.site_id.site)
+
 
 @pytest.mark.django_db
 @skipUnless(Site._meta.installed,
@@ -596,6 +1280,39 @@ class AliasTest(TestCase):
             domain=site1.domain, site=site1, is_canonical=False
         )
 
+    def test_domain_index(self):
+        if not Alias._has_domain_index(connection.alias):
+            self.skipTest('The domain index has not been migrated')
+        site = Site.objects.create(domain='example.com')
+        # Bypasses model validation
+        self.assertRaises(
+            IntegrityError,
+            Alias.objects.bulk_create,
+            [Alias(site=site, domain='EXAMPLE.com')]
+        )
+
+    def test_create_relies_on_domain_index(self):
+        if not Alias._has_domain_index(connection.alias):
+            self.skipTest('The domain index has not been migrated')
+        site = Site.objects.create(domain='example.com')
+        with CaptureQueriesContext(connection) as queries:
+            Alias.objects.create(site=site, domain='example.org')
+        self.assertFalse([q['sql'] for q in queries.captured_queries
+                          if 'LIKE' in q['sql']])
+        # Without the index, e.g. before migrating
+        with mock.patch.dict('multisite.models._domain_index_exists'), \
+                mock.patch.object(connection.introspection,
+                                  'get_constraints', return_value={}):
+            from multisite.models import _domain_index_exists
+            _domain_index_exists.clear()
+            with CaptureQueriesContext(connection) as queries:
+                Alias.objects.create(site=site, domain='example.net')
+                self.assertRaises(ValidationError, Alias.objects.create,
+                                  site=site, domain='EXAMPLE.net')
+            self.assertEqual(_domain_index_exists, {'default': False})
+        self.assertTrue([q['sql'] for q in queries.captured_queries
+                         if 'LIKE' in q['sql']])
+
     def test_repr(self):
         site = Site.objects.create(domain='example.com')
         self.assertEqual(repr(Alias.objects.get(site=site)),
@@ -689,6 +1406,45 @@ class AliasTest(TestCase):
         Alias.sync(site=site)
         self.assertFalse(Alias.objects.filter(site=site).exists())
 
+    def test_sync_concurrent(self):
+        site = Site(domain='example.com')
+        site.save_base(raw=True)
+        alias = Alias.objects.create(site=site, domain=site.domain,
+                                     is_canonical=True)
+        # Another process creates the Alias between get() and save()
+        for validate in (True, False):
+            with mock.patch.object(Alias.objects, 'get',
+                                   side_effect=[Alias.DoesNotExist, alias]):
+                self.assertEqual(Alias.sync(site=site, validate=validate),
+                                 alias)
+        self.assertEqual(Alias.objects.get(site=site), alias)
+
+    def test_save_without_validation(self):
+        site = Site.objects.create(domain='example.com')
+        alias = Alias(site=site, domain='example.org')
+        with mock.patch.object(Alias, 'full_clean') as full_clean:
+            alias.save(validate=False)
+        self.assertFalse(full_clean.called)
+        self.assertTrue(Alias.objects.filter(domain='example.org').exists())
+        # The database still rejects duplicates
+        self.assertRaises(
+            IntegrityError,
+            Alias(site=site, domain='example.org').save, validate=False
+        )
+
+    def test_sync_without_validation(self):
+        Site.objects.create()
+        site1 = Site.objects.create(domain='1.example.com')
+        site1.domain = '1.example.org'
+        site1.save_base(raw=True)
+        site2 = Site(domain='2.example.org')
+        site2.save_base(raw=True)
+        with mock.patch.object(Alias, 'full_clean') as full_clean:
+            Alias.canonical.sync_all(validate=False)
+        self.assertFalse(full_clean.called)
+        self.assertEqual(set(Alias.objects.values_list('domain', flat=True)),
+                         set([site1.domain, site2.domain]))
+
     def test_sync_blank_domain(self):
         # Create Site
         site = Site.objects.create(domain='example.com')
@@ -778,6 +1534,493 @@ class AliasTest(TestCase):
                          alias)
 
 
+@pytest.mark.django_db
+class SiteFormTest(TestCase):
+    def setUp(self):
+        self.form_class = modelform_factory(Site, form=SiteForm,
+                                            fields=('domain', 'name'))
+        self.site = Site.objects.create(domain='example.org',
+                                        name='example')
+
+    def test_clean_domain_rejects_alias(self):
+        Alias.objects.create(site=self.site, domain='Alias.example.org')
+        form = self.form_class(data={'domain': 'alias.EXAMPLE.org',
+                                     'name': 'other'})
+        self.assertFalse(form.is_valid())
+        self.assertIn('domain', form.errors)
+
+    def test_clean_domain_allows_own_canonical(self):
+        form = self.form_class(data={'domain': 'example.org',
+                                     'name': 'renamed'},
+                               instance=self.site)
+        self.assertTrue(form.is_valid())
+
+    def test_domain_checked_once(self):
+        Alias.objects.create(site=self.site, domain='alias.example.org')
+        form = self.form_class(data={'domain': 'new.example.org',
+                                     'name': 'example'},
+                               instance=self.site)
+        with CaptureQueriesContext(connection) as queries:
+            self.assertTrue(form.is_valid())
+            site = form.save()
+        case_insensitive = [q['sql'] for q in queries.captured_queries
+                            if 'LIKE' in q['sql']]
+        self.assertEqual(len(case_insensitive), 1)
+        self.assertEqual(Alias.canonical.get(site=site).domain,
+                         'new.example.org')
+
+    def test_direct_save_still_validated(self):
+        Alias.objects.create(site=self.site, domain='alias.example.org')
+        site = Site.objects.create(domain='other.example.org')
+        site._alias_domain_validated = 'other.example.org'
+        site.domain = 'ALIAS.example.org'
+        self.assertRaises(ValidationError, site.save)
+
+
+def get_changelist_instance(model_admin, request):
+    """Returns the ChangeList of ``model_admin``, like Django >= 2.0."""
+    if hasattr(model_admin, 'get_changelist_instance'):
+        return model_admin.get_changelist_instance(request)
+    list_display = model_admin.get_list_display(request)
+    list_display_links = model_admin.get_list_display_links(request,
+                                                            list_display)
+    if model_admin.get_actions(request):
+        list_display = ['action_checkbox'] + list(list_display)
+    if hasattr(model_admin, 'get_list_select_related'):
+        list_select_related = model_admin.get_list_select_related(request)
+    else:
+        # Django < 1.9
+        list_select_related = model_admin.list_select_related
+    ChangeList = model_admin.get_changelist(request)
+    return ChangeList(
+        request, model_admin.model, list_display, list_display_links,
+        model_admin.get_list_filter(request), model_admin.date_hierarchy,
+        model_admin.get_search_fields(request), list_select_related,
+        model_admin.list_per_page, model_admin.list_max_show_all,
+        model_admin.list_editable, model_admin
+    )
+
+
+class SiteScopedAliasAdmin(MultisiteModelAdmin):
+    """MultisiteModelAdmin that reads the user's Sites from the user."""
+
+    def get_user_sites(self, request):
+        return Site.objects.filter(pk__in=request.user.multisite_site_ids)
+
+
+@pytest.mark.django_db
+class MultisiteModelAdminTest(TestCase):
+    def setUp(self):
+        Site.objects.all().delete()
+        self.site1 = Site.objects.create(domain='1.example')
+        self.site2 = Site.objects.create(domain='2.example')
+        self.site3 = Site.objects.create(domain='3.example')
+        self.user = User.objects.create_user(username='editor')
+        self.user.user_permissions.add(
+            Permission.objects.get(codename='change_alias')
+        )
+        self.user.multisite_site_ids = [self.site1.pk, self.site2.pk]
+        self.superuser = User.objects.create_superuser(
+            username='admin', email='admin@example.com', password='admin'
+        )
+        self.model_admin = SiteScopedAliasAdmin(Alias, AdminSite())
+        self.factory = DjangoRequestFactory()
+
+    def get_request(self, user):
+        request = self.factory.get('/')
+        request.user = user
+        return request
+
+    def test_get_queryset(self):
+        request = self.get_request(self.user)
+        self.assertEqual(
+            set(self.model_admin.get_queryset(request).values_list(
+                'domain', flat=True
+            )),
+            set(['1.example', '2.example'])
+        )
+        request = self.get_request(self.superuser)
+        self.assertEqual(
+            set(self.model_admin.get_queryset(request).values_list(
+                'domain', flat=True
+            )),
+            set(['1.example', '2.example', '3.example'])
+        )
+
+    def test_user_sites_memoized(self):
+        request = self.get_request(self.user)
+        site_field = Alias._meta.get_field('site')
+        with self.assertNumQueries(1):
+            self.assertEqual(
+                sorted(self.model_admin.get_user_site_ids(request)),
+                sorted([self.site1.pk, self.site2.pk])
+            )
+            self.model_admin.get_user_site_ids(request)
+            self.model_admin.get_queryset(request)
+            kwargs = self.model_admin.handle_multisite_foreign_keys(
+                site_field, request
+            )
+            self.assertEqual(
+                sorted(get_user_site_choices(request)),
+                [(self.site1.pk, '1.example'), (self.site2.pk, '2.example')]
+            )
+        self.assertEqual(set(kwargs['queryset']),
+                         set([self.site1, self.site2]))
+        # A new request resolves the Sites again
+        with self.assertNumQueries(1):
+            self.model_admin.get_user_site_ids(self.get_request(self.user))
+
+    def test_filter_by_site_fk(self):
+        qs = self.model_admin.filter_by_sites(Alias.canonical.all(), 'site',
+                                              [self.site1.pk])
+        self.assertNotIn('JOIN', str(qs.query))
+        self.assertEqual(list(qs.values_list('domain', flat=True)),
+                         ['1.example'])
+
+    def get_site_filter(self, request):
+        self.model_admin.list_filter = ('site',)
+        changelist = get_changelist_instance(self.model_admin, request)
+        filter_spec, = changelist.filter_specs
+        self.assertIsInstance(filter_spec, SiteListFilter)
+        return changelist, filter_spec
+
+    def test_site_filter(self):
+        from django.contrib.admin.templatetags.admin_list import \
+            admin_list_filter
+        request = self.get_request(self.user)
+        changelist, filter_spec = self.get_site_filter(request)
+        self.assertEqual(filter_spec.lookup_choices,
+                         [(self.site1.pk, '1.example'),
+                          (self.site2.pk, '2.example')])
+        self.assertFalse(filter_spec.searchable)
+        self.assertIn('2.example', admin_list_filter(changelist, filter_spec))
+
+        request = self.get_request(self.superuser)
+        changelist, filter_spec = self.get_site_filter(request)
+        self.assertEqual(len(filter_spec.lookup_choices), 3)
+
+    def test_site_filter_search(self):
+        from django.contrib.admin.templatetags.admin_list import \
+            admin_list_filter
+        with mock.patch.object(SiteListFilter, 'max_choices', 2):
+            request = self.get_request(self.superuser)
+            changelist, filter_spec = self.get_site_filter(request)
+            self.assertEqual(filter_spec.lookup_choices,
+                             [(self.site1.pk, '1.example'),
+                              (self.site2.pk, '2.example')])
+            self.assertTrue(filter_spec.searchable)
+            self.assertIn('name="site__domain__icontains"',
+                          admin_list_filter(changelist, filter_spec))
+
+            request = self.factory.get('/', {'site__domain__icontains': '3.',
+                                             'o': '1'})
+            request.user = self.superuser
+            changelist, filter_spec = self.get_site_filter(request)
+            self.assertEqual(filter_spec.lookup_choices,
+                             [(self.site3.pk, '3.example')])
+            self.assertEqual(filter_spec.search_params, ())
+            admin_list_filter(changelist, filter_spec)
+            self.assertEqual(filter_spec.search_params, [('o', '1')])
+            self.assertEqual(
+                list(changelist.get_queryset(request).values_list(
+                    'domain', flat=True
+                )),
+                ['3.example']
+            )
+
+    @skipIf(SiteScopedAutocompleteSelect is None,
+            'AutocompleteSelect requires Django 2.0')
+    def test_autocomplete_widget(self):
+        site_field = Alias._meta.get_field('site')
+        request = self.get_request(self.user)
+        formfield = self.model_admin.formfield_for_foreignkey(site_field,
+                                                              request)
+        self.assertNotIsInstance(formfield.widget,
+                                 SiteScopedAutocompleteSelect)
+
+        self.model_admin.multisite_autocomplete_threshold = 2
+        formfield = self.model_admin.formfield_for_foreignkey(site_field,
+                                                              request)
+        self.assertNotIsInstance(formfield.widget,
+                                 SiteScopedAutocompleteSelect)
+
+        request = self.get_request(self.superuser)
+        formfield = self.model_admin.formfield_for_foreignkey(site_field,
+                                                              request)
+        widget = formfield.widget
+        self.assertIsInstance(widget, SiteScopedAutocompleteSelect)
+        self.assertEqual(widget.field_name, 'site')
+        self.assertEqual(widget.model, Alias)
+        self.assertEqual(self.model_admin.get_urls()[0].name,
+                         'multisite_alias_multisite_autocomplete')
+
+    def get_autocomplete(self, user, **params):
+        import json
+        request = self.factory.get('/', params)
+        request.user = user
+        response = self.model_admin.multisite_autocomplete_view(request,
+                                                                'site')
+        return json.loads(response.content.decode('utf-8'))
+
+    @skipIf(SiteScopedAutocompleteSelect is None,
+            'AutocompleteSelect requires Django 2.0')
+    def test_autocomplete_view(self):
+        self.assertEqual(
+            self.get_autocomplete(self.user),
+            {'results': [{'id': str(self.site1.pk), 'text': '1.example'},
+                         {'id': str(self.site2.pk), 'text': '2.example'}],
+             'pagination': {'more': False}}
+        )
+        self.assertEqual(
+            self.get_autocomplete(self.superuser, term='3.'),
+            {'results': [{'id': str(self.site3.pk), 'text': '3.example'}],
+             'pagination': {'more': False}}
+        )
+        self.model_admin.multisite_autocomplete_page_size = 2
+        self.assertEqual(
+            self.get_autocomplete(self.superuser)['pagination'],
+            {'more': True}
+        )
+        self.assertEqual(
+            self.get_autocomplete(self.superuser, page=2)['results'],
+            [{'id': str(self.site3.pk), 'text': '3.example'}]
+        )
+
+    def test_autocomplete_view_errors(self):
+        request = self.get_request(self.user)
+        self.assertRaises(Http404,
+                          self.model_admin.multisite_autocomplete_view,
+                          request, 'domain')
+        self.assertRaises(Http404,
+                          self.model_admin.multisite_autocomplete_view,
+                          request, 'missing')
+        request = self.get_request(User.objects.create_user(username='other'))
+        self.assertRaises(PermissionDenied,
+                          self.model_admin.multisite_autocomplete_view,
+                          request, 'site')
+
+    def test_object_site_ids(self):
+        self.model_admin.filter_sites_by_current_object = True
+        alias = Alias.objects.get(site=self.site2)
+        request = self.get_request(self.user)
+        self.assertEqual(self.model_admin.get_object_site_ids(request), None)
+
+        request = self.get_request(self.user)
+        self.assertEqual(
+            self.model_admin.get_object(request, str(alias.pk)), alias
+        )
+        with self.assertNumQueries(0):
+            self.assertEqual(self.model_admin.get_object_site_ids(request),
+                             (self.site2.pk,))
+        self.assertFalse(hasattr(self.model_admin, 'object_sites'))
+
+        # A request for another object doesn't see the first one's sites
+        other = self.get_request(self.user)
+        self.model_admin.get_object(other, str(Alias.objects.get(
+            site=self.site1
+        ).pk))
+        self.assertEqual(self.model_admin.get_object_site_ids(other),
+                         (self.site1.pk,))
+        self.assertEqual(self.model_admin.get_object_site_ids(request),
+                         (self.site2.pk,))
+
+    @skipIf(django.VERSION < (1, 10), 'isolate_apps requires Django 1.10')
+    @isolate_apps('multisite')
+    def test_filter_by_sites_m2m(self):
+        from django.db import models
+
+        # Stands in for Site, which isn't part of the isolated apps
+        class Tenant(models.Model):
+            pass
+
+        class Article(models.Model):
+            sites = models.ManyToManyField(Tenant)
+
+        class Comment(models.Model):
+            article = models.ForeignKey(Article, on_delete=models.CASCADE)
+
+        qs = self.model_admin.filter_by_sites(Article.objects.all(), 'sites',
+                                              [self.site1.pk])
+        sql = str(qs.query)
+        self.assertNotIn('DISTINCT', sql)
+        self.assertNotIn('JOIN', sql.split('IN (SELECT')[0])
+
+        qs = self.model_admin.filter_by_sites(Comment.objects.all(),
+                                              'article__sites',
+                                              [self.site1.pk])
+        sql = str(qs.query)
+        self.assertNotIn('DISTINCT', sql)
+        self.assertNotIn('JOIN', sql.split('IN (SELECT')[0])
+
+
+@pytest.mark.django_db
+class SiteAdminTest(TestCase):
+    def setUp(self):
+        from django.contrib import admin
+        Site.objects.all().delete()
+        self.site1 = Site.objects.create(domain='1.example')
+        self.site2 = Site.objects.create(domain='2.example')
+        for i in range(7):
+            Alias.objects.create(site=self.site1, domain='%d.1.example' % i)
+        Alias.objects.create(site=self.site2, domain='www.2.example')
+        self.site_admin = admin.site._registry[Site]
+        self.request = DjangoRequestFactory().get('/', {'o': '-3'})
+        self.request.user = User.objects.create_superuser(
+            username='admin', email='admin@example.com', password='admin'
+        )
+
+    def test_changelist(self):
+        changelist = get_changelist_instance(self.site_admin, self.request)
+        with self.assertNumQueries(2):
+            rows = [(self.site_admin.alias_count(site),
+                     self.site_admin.alias_domains(site))
+                    for site in changelist.result_list]
+        self.assertEqual(rows, [
+            (7, '0.1.example, 1.1.example, 2.1.example, 3.1.example, '
+                '4.1.example, ...'),
+            (1, 'www.2.example'),
+        ])
+
+    def test_alias_domains_without_prefetch(self):
+        self.assertEqual(self.site_admin.alias_domains(self.site2),
+                         'www.2.example')
+
+
+class SpanningCurrentSiteManagerTest(TestCase):
+    @skipIf(django.VERSION < (1, 10), 'isolate_apps requires Django 1.10')
+    @isolate_apps('multisite')
+    def test_foreign_key_chain(self):
+        from django.db import models
+
+        class Family(models.Model):
+            site = models.ForeignKey(Site, on_delete=models.CASCADE)
+
+        class Layer(models.Model):
+            family = models.ForeignKey(Family, on_delete=models.CASCADE)
+            on_site = SpanningCurrentSiteManager('family__site')
+
+        self.assertEqual(Layer.on_site.check(), [])
+        with mock.patch.object(SpanningCurrentSiteManager,
+                               '_validate_field_name') as validate:
+            sql = str(Layer.on_site.all().query)
+        self.assertFalse(validate.called)
+        self.assertEqual(sql.count('JOIN'), 1)
+        self.assertNotIn(Site._meta.db_table, sql)
+        self.assertIn('"site_id" = %s' % settings.SITE_ID, sql)
+
+    @skipIf(django.VERSION < (1, 10), 'isolate_apps requires Django 1.10')
+    @isolate_apps('multisite')
+    def test_guessed_field_name(self):
+        from django.db import models
+
+        class Family(models.Model):
+            site = models.ForeignKey(Site, on_delete=models.CASCADE)
+            on_site = SpanningCurrentSiteManager()
+
+        self.assertEqual(Family.on_site.get_site_lookup(), 'site_id')
+
+    @skipIf(django.VERSION < (1, 10), 'isolate_apps requires Django 1.10')
+    @isolate_apps('multisite')
+    def test_invalid_chain(self):
+        from django.db import models
+
+        class Family(models.Model):
+            name = models.CharField(max_length=10)
+
+        class Layer(models.Model):
+            family = models.ForeignKey(Family, on_delete=models.CASCADE)
+            on_site = SpanningCurrentSiteManager('family__site')
+            by_name = SpanningCurrentSiteManager('family__name')
+
+        errors = Layer.on_site.check()
+        self.assertEqual([e.id for e in errors], ['multisite.E001'])
+        self.assertRaises(ValueError, Layer.on_site.all)
+        self.assertEqual([e.id for e in Layer.by_name.check()],
+                         ['multisite.E001'])
+
+
+@pytest.mark.django_db(transaction=True)
+class DenormalizedSiteTest(TransactionTestCase):
+    # Creates tables, which SQLite can't do inside a transaction. Flushing
+    # the database afterwards recreates the default Site, through
+    # post_migrate, for the tests that follow.
+    @skipIf(django.VERSION < (1, 10), 'isolate_apps requires Django 1.10')
+    @isolate_apps('multisite')
+    def test_denormalized_site(self):
+        from django.db import models
+
+        class Family(models.Model):
+            site = models.ForeignKey(Site, on_delete=models.CASCADE)
+
+        class Layer(models.Model):
+            family = models.ForeignKey(Family, on_delete=models.CASCADE)
+            site = models.ForeignKey(Site, null=True, editable=False,
+                                     related_name='+',
+                                     on_delete=models.CASCADE)
+            objects = models.Manager()
+            on_site = SpanningCurrentSiteManager('family__site',
+                                                 site_field_name='site')
+
+        self.assertEqual(Layer.on_site.check(), [])
+        self.assertEqual(Layer.on_site.get_site_lookup(), 'site_id')
+        self.assertNotIn('JOIN', str(Layer.on_site.all().query))
+        # The chain is only walked once
+        with mock.patch.object(SpanningCurrentSiteManager,
+                               '_get_related_model') as get_related_model:
+            Layer.on_site.all()
+            Layer.on_site._get_site_field()
+            self.assertFalse(get_related_model.called)
+
+        with connection.schema_editor() as editor:
+            editor.create_model(Family)
+            editor.create_model(Layer)
+        try:
+            site1 = Site.objects.create(domain='1.example')
+            site2 = Site.objects.create(domain='2.example')
+            family = Family.objects.create(site=site1)
+            with CaptureQueriesContext(connection) as queries:
+                layer = Layer.objects.create(family=family)
+            # The Site is read in one query. Before Django 2.2, save() also
+            # starts a transaction.
+            self.assertEqual(len([q for q in queries.captured_queries
+                                  if not q['sql'].startswith('BEGIN')]), 2)
+            self.assertEqual(layer.site_id, site1.pk)
+            with settings.SITE_ID.override(site1.pk):
+                self.assertEqual(list(Layer.on_site.all()), [layer])
+
+            Family.objects.filter(pk=family.pk).update(site=site2)
+            out = StringIO()
+            with mock.patch('django.apps.apps.get_models',
+                            return_value=[Family, Layer]):
+                call_command('sync_denormalized_sites', stdout=out)
+            self.assertEqual(out.getvalue(),
+                             'multisite.Layer.site: 1 updated\n')
+            self.assertEqual(Layer.on_site.sync_site_field(), 0)
+            with settings.SITE_ID.override(site2.pk):
+                self.assertEqual(list(Layer.on_site.all()), [layer])
+        finally:
+            with connection.schema_editor() as editor:
+                editor.delete_model(Layer)
+                editor.delete_model(Family)
+
+    @skipIf(django.VERSION < (1, 10), 'isolate_apps requires Django 1.10')
+    @isolate_apps('multisite')
+    def test_denormalized_site_needs_foreign_keys(self):
+        from django.db import models
+
+        class Family(models.Model):
+            sites = models.ManyToManyField(Site)
+
+        class Layer(models.Model):
+            family = models.ForeignKey(Family, on_delete=models.CASCADE)
+            site = models.ForeignKey(Site, null=True, related_name='+',
+                                     on_delete=models.CASCADE)
+            on_site = SpanningCurrentSiteManager('family__sites',
+                                                 site_field_name='site')
+
+        self.assertEqual([e.id for e in Layer.on_site.check()],
+                         ['multisite.E002'])
+
 
 @pytest.mark.django_db
 @override_settings(
@@ -1057,6 +2300,218 @@ class TemplateLoaderTests(TestCase):
             self.assertEqual(template.render(), "Test!")
 
 
+def _template_settings(template_dir, loaders=None):
+    return {'TEMPLATES': [
+        {
+            'BACKEND': 'django.template.backends.django.DjangoTemplates',
+            'DIRS': [template_dir],
+            'OPTIONS': {
+                'loaders': loaders or [
+                    'multisite.template.loaders.filesystem.Loader',
+                ]
+            },
+        }
+    ]}
+
+
+class TemplateSourceCacheTests(TestCase):
+
+    def setUp(self):
+        self.template_dir = tempfile.mkdtemp()
+        self.write_template('default', 'page.html', 'default page')
+
+    def tearDown(self):
+        shutil.rmtree(self.template_dir)
+
+    def write_template(self, dirname, name, contents):
+        path = os.path.join(self.template_dir, dirname)
+        if not os.path.isdir(path):
+            os.makedirs(path)
+        with open(os.path.join(path, name), 'w') as f:
+            f.write(contents)
+
+    def get_loader(self):
+        return engines['django'].engine.template_loaders[0]
+
+    def test_invalid_mode(self):
+        with override_settings(MULTISITE_TEMPLATE_SOURCE_CACHE='invalid',
+                               **_template_settings(self.template_dir)):
+            self.assertRaises(ImproperlyConfigured, get_template, 'page.html')
+
+    def test_disabled(self):
+        with override_settings(MULTISITE_TEMPLATE_SOURCE_CACHE=None,
+                               **_template_settings(self.template_dir)):
+            self.assertEqual(get_template('page.html').render(),
+                             'default page')
+            self.assertEqual(self.get_loader().source_cache, {})
+            self.write_template('example.com', 'page.html', 'site page')
+            self.assertEqual(get_template('page.html').render(), 'site page')
+
+    def test_static(self):
+        with override_settings(MULTISITE_TEMPLATE_SOURCE_CACHE='static',
+                               **_template_settings(self.template_dir)):
+            self.assertEqual(get_template('page.html').render(),
+                             'default page')
+            loader = self.get_loader()
+            sources = loader.source_cache[('example.com', 'page.html')][0]
+            self.assertEqual(
+                [getattr(source, 'name', source) for source in sources],
+                [os.path.join(self.template_dir, 'default', 'page.html')]
+            )
+            # New overrides are not picked up until the loader is reset
+            self.write_template('example.com', 'page.html', 'site page')
+            self.assertEqual(get_template('page.html').render(),
+                             'default page')
+            loader.reset()
+            self.assertEqual(get_template('page.html').render(), 'site page')
+
+    def test_missing_template(self):
+        with override_settings(MULTISITE_TEMPLATE_SOURCE_CACHE='static',
+                               **_template_settings(self.template_dir)):
+            self.assertRaises(TemplateDoesNotExist,
+                              get_template, 'missing.html')
+            self.assertEqual(
+                self.get_loader().source_cache[
+                    ('example.com', 'missing.html')][0],
+                ()
+            )
+
+    def test_mtime(self):
+        with override_settings(MULTISITE_TEMPLATE_SOURCE_CACHE='mtime',
+                               **_template_settings(self.template_dir)):
+            self.assertEqual(get_template('page.html').render(),
+                             'default page')
+            self.write_template('example.com', 'page.html', 'site page')
+            self.assertEqual(get_template('page.html').render(), 'site page')
+            os.remove(os.path.join(self.template_dir, 'example.com',
+                                   'page.html'))
+            self.assertEqual(get_template('page.html').render(),
+                             'default page')
+
+    def test_index(self):
+        self.write_template(os.path.join('default', 'sub'), 'nested.html',
+                            'default nested')
+        with override_settings(MULTISITE_TEMPLATE_SOURCE_CACHE='index',
+                               **_template_settings(self.template_dir)):
+            self.assertEqual(get_template('page.html').render(),
+                             'default page')
+            self.assertEqual(get_template('sub/nested.html').render(),
+                             'default nested')
+            self.assertRaises(TemplateDoesNotExist,
+                              get_template, 'missing.html')
+            loader = self.get_loader()
+            self.assertEqual(loader.directory_index['example.com'],
+                             frozenset())
+            self.assertEqual(
+                loader.directory_index['default'],
+                frozenset([
+                    os.path.join(self.template_dir, 'default', 'page.html'),
+                    os.path.join(self.template_dir, 'default', 'sub',
+                                 'nested.html'),
+                ])
+            )
+            # New overrides are not picked up until the loader is reset
+            self.write_template('example.com', 'page.html', 'site page')
+            self.assertEqual(get_template('page.html').render(),
+                             'default page')
+            loader.reset()
+            self.assertEqual(get_template('page.html').render(), 'site page')
+
+
+@override_settings(SITE_ID=SiteID(default=1))
+class CachedTemplateLoaderTests(TestCase):
+    loaders = [
+        ('multisite.template.loaders.cached.Loader',
+         ['multisite.template.loaders.filesystem.Loader']),
+    ]
+
+    def setUp(self):
+        Site.objects.all().delete()
+        self.site1 = Site.objects.create(domain='example.com')
+        self.site2 = Site.objects.create(domain='example.org')
+        self.template_dir = tempfile.mkdtemp()
+        for dirname in ('default', 'example.com', 'example.org'):
+            os.makedirs(os.path.join(self.template_dir, dirname))
+        self.write_template('default', 'a.html', 'default a')
+        self.write_template('default', 'b.html', 'default b')
+        self.write_template('example.com', 'a.html', 'example.com a')
+
+    def tearDown(self):
+        shutil.rmtree(self.template_dir)
+
+    def write_template(self, dirname, name, contents):
+        with open(os.path.join(self.template_dir, dirname, name), 'w') as f:
+            f.write(contents)
+
+    def get_loader(self):
+        return engines['django'].engine.template_loaders[0]
+
+    def render(self, site, template_name):
+        with settings.SITE_ID.override(site.pk):
+            return get_template(template_name).render()
+
+    def get_cache(self):
+        loader = self.get_loader()
+        if django.VERSION < (1, 9):
+            # Holds (template, origin) pairs
+            return loader.template_cache
+        return loader.get_template_cache
+
+    def render_cached(self, domain, template_name):
+        template = self.get_cache()[(domain, template_name)]
+        if isinstance(template, tuple):
+            template = template[0]
+        return template.render(Context())
+
+    def test_cache_per_site(self):
+        with override_settings(**_template_settings(self.template_dir,
+                                                    self.loaders)):
+            self.assertEqual(self.render(self.site1, 'a.html'),
+                             'example.com a')
+            self.assertEqual(self.render(self.site2, 'a.html'), 'default a')
+            self.assertEqual(self.render(self.site1, 'a.html'),
+                             'example.com a')
+            cache = self.get_cache()
+            self.assertEqual(sorted(cache.domains()),
+                             ['example.com', 'example.org'])
+            self.assertEqual(len(cache), 2)
+
+    def test_missing_template(self):
+        with override_settings(**_template_settings(self.template_dir,
+                                                    self.loaders)):
+            for i in range(2):
+                self.assertRaises(TemplateDoesNotExist,
+                                  self.render, self.site1, 'missing.html')
+
+    def test_max_entries_per_site(self):
+        with override_settings(MULTISITE_CACHED_TEMPLATES_PER_SITE=1,
+                               **_template_settings(self.template_dir,
+                                                    self.loaders)):
+            self.render(self.site1, 'a.html')
+            self.render(self.site1, 'b.html')
+            self.render(self.site2, 'a.html')
+            cache = self.get_cache()
+            self.assertEqual(len(cache), 2)
+            self.assertNotIn(('example.com', 'a.html'), cache)
+            self.assertIn(('example.com', 'b.html'), cache)
+            self.assertIn(('example.org', 'a.html'), cache)
+
+    def test_warm(self):
+        from .template.loaders.cached import warm_template_cache
+        with override_settings(**_template_settings(self.template_dir,
+                                                    self.loaders)):
+            warm_template_cache(['a.html', 'missing.html'])
+            cache = self.get_cache()
+            self.assertEqual(self.render_cached('example.com', 'a.html'),
+                             'example.com a')
+            self.assertEqual(self.render_cached('example.org', 'a.html'),
+                             'default a')
+            # Only the first site is warmed
+            self.get_loader().reset()
+            warm_template_cache(['a.html'], sites=[self.site1])
+            self.assertEqual(cache.domains(), ['example.com'])
+
+
 class UpdatePublicSuffixListCommandTestCase(TestCase):
 
     def setUp(self):
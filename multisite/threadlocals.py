@@ -104,21 +104,36 @@ class SiteID(local):
            ...    print settings.SITE_ID
            2
         """
-        site_id_original = self.site_id
+        original = (self.site_id, self.site, self.memoize)
         self.set(value)
         try:
             yield self
         finally:
-            self.site_id = site_id_original
+            self.site_id, self.site, self.memoize = original
 
-    def set(self, value):
+    def set(self, value, memoize=False):
+        """
+        Sets SITE_ID to ``value``, a Site or its id.
+
+        With ``memoize``, Site.objects.get_current() remembers the Site it
+        returns until SITE_ID changes, e.g. for the rest of a request.
+        """
         from django.db.models import Model
         if isinstance(value, Model):
             value = value.pk
         self.site_id = value
+        self.site = None
+        self.memoize = memoize
+
+    def set_site(self, site):
+        """Sets SITE_ID to ``site``, and memoizes it."""
+        self.set(site, memoize=True)
+        self.site = site
 
     def reset(self):
         self.site_id = None
+        self.site = None
+        self.memoize = False
 
     def get_default(self):
         """Returns the default SITE_ID."""